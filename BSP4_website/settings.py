@@ -127,3 +127,67 @@ STATIC_URL = '/static/'
 GEOIP_PATH = os.path.join(BASE_DIR, 'geoip')
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
+
+# Landsat scene list and the columnar catalogue built from it (see satellite_data_processing/catalogue.py)
+SCENE_LIST = os.path.join(BASE_DIR, 'scene_list.gz')
+SCENE_CATALOGUE_DIR = os.path.join(BASE_DIR, 'scene_catalogue')
+
+# Caches
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# 'scene_selection' keeps the scenes selected by every user (see satellite_data_processing/selection.py) and 'tiles'
+# the rendered map tiles. Both are file based caches, so they are shared by all the worker processes serving the
+# website (a selection stored by one worker is found by the next request, whichever worker serves it).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'scene_selection': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'django_cache', 'scene_selection'),
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+# Downloaded (and masked) Landsat bands are kept between the requests (see satellite_data_processing/disk_cache.py)
+BAND_CACHE_DIR = os.path.join(BASE_DIR, 'band_cache')
+BAND_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+# Rasterized country masks (packed bits) of the grids of the path/rows (see satellite_data_processing/disk_cache.py)
+MASK_CACHE_DIR = os.path.join(BASE_DIR, 'mask_cache')
+MASK_CACHE_MAX_BYTES = 1024 ** 3
+
+# Number of worker processes processing the scenes in parallel (see satellite_data_processing/pipeline.py),
+# None uses one process per core
+PIPELINE_WORKERS = None
+
+# Number of jobs (processing of the selected scenes) executed at the same time in the background
+# (see satellite_data_processing/jobs.py)
+JOB_WORKERS = 2
+
+# A running job without progress for this many seconds is failed (e.g. its server process was stopped)
+JOB_TIMEOUT = 60 * 60
+
+# Results of the jobs (indicator rasters and image) are kept for repeated requests
+# (see satellite_data_processing/disk_cache.py)
+RESULT_CACHE_DIR = os.path.join(BASE_DIR, 'result_cache')
+RESULT_CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+# Rendered map tiles of the results, the least recently used tiles are removed first
+# (see satellite_data_processing/tiles.py)
+TILE_CACHE_DIR = os.path.join(BASE_DIR, 'tile_cache')
+TILE_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+# Creation options of the masked bands and of the indicator rasters: 'raw' (striped, uncompressed), 'deflate', 'zstd'
+# (tiled 512x512, compressed with a predictor) or 'cog' (Cloud-Optimized GeoTIFF with overviews)
+# (see satellite_data_processing/utils.py)
+MASK_OUTPUT_PROFILE = 'deflate'
+INDICATOR_OUTPUT_PROFILE = 'cog'
+
+# Tile urls of the Earth Engine layers are kept for EE_TILE_URL_TTL seconds and refreshed in the background after
+# EE_TILE_URL_REFRESH of that time (see satellite_data_processing/ee_layers.py)
+EE_TILE_URL_TTL = 60 * 60 * 4
+EE_TILE_URL_REFRESH = 0.75
@@ -3,3 +3,4 @@ from .models import *
 
 admin.site.register(Location)
 admin.site.register(Indicator)
+admin.site.register(Job)
@@ -0,0 +1,340 @@
+import gzip
+import io
+import itertools
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+# --------------------------------------------------- Scene catalogue --------------------------------------------------
+# The Landsat scene list (scene_list.gz) is converted once into a columnar store: one .npy file per column, sorted by
+# (path, row, acquisitionDate) and memory-mapped when read. Every (path, row) is a contiguous partition of the columns,
+# so getting the scenes of a path/row in a date range is an index slice instead of parsing the whole csv file.
+#
+# Layout of the catalogue directory:
+#   CURRENT                     name of the version which is currently used
+#   <version>/manifest.json     source file, number of rows and high-water mark of this version
+#   <version>/<column>.npy      one file per column of the scene list (+ the flags column)
+#   <version>/partitions.npy    sorted keys (path * 1000 + row) of the partitions
+#   <version>/offsets.npy       start of every partition in the columns (+ the total number of rows at the end)
+
+COLUMNS = ['productId', 'entityId', 'acquisitionDate', 'cloudCover', 'processingLevel', 'path', 'row',
+           'min_lat', 'min_lon', 'max_lat', 'max_lon', 'download_url']
+
+STRING_COLUMNS = ['productId', 'entityId', 'processingLevel', 'download_url']
+
+NUMERIC_COLUMNS = {
+    'cloudCover': 'float64',
+    'path': 'int64',
+    'row': 'int64',
+    'min_lat': 'float64',
+    'min_lon': 'float64',
+    'max_lat': 'float64',
+    'max_lon': 'float64',
+}
+
+# columns the scene listing can be sorted by
+SORT_COLUMNS = ['acquisitionDate', 'cloudCover', 'path', 'row']
+
+# flags precomputed for every scene, the scenes with one of the EXCLUDED flags are not shown to the user
+FLAG_T2 = 1  # Tier 2 scenes
+FLAG_RT = 2  # Real-Time scenes
+EXCLUDED = FLAG_T2 | FLAG_RT
+
+
+def get_scene_list_path():
+    return getattr(settings, 'SCENE_LIST', 'scene_list.gz')
+
+
+def get_catalogue_dir():
+    return getattr(settings, 'SCENE_CATALOGUE_DIR', 'scene_catalogue')
+
+
+def partition_key(path, row):
+    return np.asarray(path, dtype='int64') * 1000 + np.asarray(row, dtype='int64')
+
+
+def scene_flags(product_ids):
+    product_ids = pd.Series(product_ids, dtype=object)
+    flags = np.zeros(len(product_ids), dtype='uint8')
+    flags[product_ids.str.contains('_T2').to_numpy()] |= FLAG_T2
+    flags[product_ids.str.contains('_RT').to_numpy()] |= FLAG_RT
+    return flags
+
+
+def frame_to_columns(frame):
+    # convert a dataframe of the scene list into the arrays stored in the catalogue (not sorted yet)
+    columns = {}
+    for name in STRING_COLUMNS:
+        columns[name] = frame[name].fillna('').astype(str).to_numpy().astype('S')
+    for name, dtype in NUMERIC_COLUMNS.items():
+        columns[name] = frame[name].to_numpy(dtype=dtype)
+    # the dates of the scene list have fractional seconds or not (e.g. 2017-02-16 10:08:57.496393, 2015-01-01 10:00:00)
+    dates = pd.to_datetime(frame['acquisitionDate'], format='ISO8601')
+    columns['acquisitionDate'] = dates.to_numpy().astype('datetime64[us]')
+    columns['flags'] = scene_flags(frame['productId'].fillna(''))
+    return columns
+
+
+def write_catalogue(columns, directory=None, manifest=None):
+    # sort the columns by partition and date, write them into a new version and switch CURRENT to it
+    directory = directory or get_catalogue_dir()
+    os.makedirs(directory, exist_ok=True)
+
+    keys = partition_key(columns['path'], columns['row'])
+    order = np.lexsort((columns['acquisitionDate'], keys))
+    keys = keys[order]
+
+    version = uuid.uuid4().hex
+    version_dir = os.path.join(directory, version)
+    os.makedirs(version_dir)
+
+    for name, values in columns.items():
+        np.save(os.path.join(version_dir, name + '.npy'), values[order])
+
+    partitions, starts = np.unique(keys, return_index=True)
+    np.save(os.path.join(version_dir, 'partitions.npy'), partitions)
+    np.save(os.path.join(version_dir, 'offsets.npy'), np.append(starts, len(keys)))
+
+    manifest = dict(manifest or {})
+    manifest['rows'] = int(len(keys))
+    with open(os.path.join(version_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    # switching the version is atomic, readers which still use the old version keep their memory maps
+    current_tmp = os.path.join(directory, 'CURRENT.' + version)
+    with open(current_tmp, 'w') as f:
+        f.write(version)
+    os.replace(current_tmp, os.path.join(directory, 'CURRENT'))
+
+    # remove the versions which are not used anymore
+    for element in os.listdir(directory):
+        element_path = os.path.join(directory, element)
+        if element != version and os.path.isdir(element_path):
+            shutil.rmtree(element_path, ignore_errors=True)
+
+    return version_dir
+
+
+class CatalogueError(Exception):
+    pass
+
+
+def scene_keys(product_ids):
+    # the same acquisition keeps sensor, path/row and date in its productId when it is processed again,
+    # e.g. LC08_L1TP_192027_20210214_20210214_01_RT -> LC08_L1TP_192027_20210214_20210304_01_T1
+    # (the processing level at characters 5-8 is dropped as well, it can change between two versions)
+    characters = np.ascontiguousarray(np.asarray(product_ids).astype('S25')).view('S1').reshape(-1, 25)
+    return np.ascontiguousarray(np.hstack([characters[:, :4], characters[:, 9:]])).view('S20').ravel()
+
+
+def drop_superseded(columns):
+    # remove the Real-Time scenes for which a processed (Tier 1 / Tier 2) version of the same acquisition exists
+    keys = scene_keys(columns['productId'])
+    real_time = (columns['flags'] & FLAG_RT) != 0
+    superseded = real_time & np.isin(keys, keys[~real_time])
+    return {name: values[~superseded] for name, values in columns.items()}
+
+
+def high_water_mark(columns, source_rows, last_product_id):
+    # position in the scene list up to which the rows are in the catalogue
+    return {
+        'source_rows': int(source_rows),
+        'productId': last_product_id,
+        'acquisitionDate': str(columns['acquisitionDate'].max()) if len(columns['acquisitionDate']) else None,
+    }
+
+
+def build_catalogue(source=None, directory=None):
+    # parse the whole scene list once and write it into the catalogue
+    source = source or get_scene_list_path()
+    print("---- Building scene catalogue from: {}".format(source))
+
+    frame = pd.read_csv(source, compression='gzip')
+    columns = frame_to_columns(frame)
+    manifest = {
+        'source': str(source),
+        'high_water_mark': high_water_mark(columns, len(frame),
+                                           str(frame['productId'].iloc[-1]) if len(frame) else None),
+    }
+    return write_catalogue(drop_superseded(columns), directory, manifest)
+
+
+def refresh_catalogue(source=None, directory=None):
+    # ingest only the rows appended to the scene list since the last build/refresh
+    source = source or get_scene_list_path()
+    version_dir = current_version_dir(directory)
+    if version_dir is None:
+        return build_catalogue(source, directory), None
+
+    catalogue = SceneCatalogue(version_dir)
+    mark = catalogue.manifest.get('high_water_mark')
+    if mark is None:
+        raise CatalogueError("The catalogue has no high-water mark, it has to be rebuilt")
+
+    with gzip.open(source, 'rt', newline='') as f:
+        header = next(f)
+
+        # the rows already in the catalogue are only decompressed, not parsed;
+        # the last one has to be the row of the high-water mark, otherwise the scene list was rewritten
+        skipped, last_line = 0, None
+        for skipped, last_line in enumerate(itertools.islice(f, mark['source_rows']), 1):
+            pass
+        if skipped != mark['source_rows'] or (last_line is not None
+                                              and last_line.split(',', 1)[0] != mark['productId']):
+            raise CatalogueError("The scene list does not continue the rows of the catalogue, it has to be rebuilt")
+
+        new_rows = f.read()
+
+    if not new_rows.strip():
+        return version_dir, 0
+
+    frame = pd.read_csv(io.StringIO(header + new_rows))
+    print("---- Ingesting {} new scenes from: {}".format(len(frame), source))
+    new_columns = frame_to_columns(frame)
+
+    # rows of the catalogue which are ingested again are replaced by the new ones
+    old_columns = {name: np.asarray(values) for name, values in catalogue.columns.items()}
+    kept = ~np.isin(old_columns['productId'], new_columns['productId'])
+    columns = {name: np.concatenate([old_columns[name][kept], new_columns[name]]) for name in old_columns}
+
+    manifest = dict(catalogue.manifest)
+    mark = high_water_mark(columns, mark['source_rows'] + len(frame), str(frame['productId'].iloc[-1]))
+    manifest['high_water_mark'] = mark
+    return write_catalogue(drop_superseded(columns), directory, manifest), len(frame)
+
+
+class SceneCatalogue:
+    """Read-only view on one version of the catalogue, the columns are memory-mapped."""
+
+    def __init__(self, version_dir):
+        self.version_dir = version_dir
+        with open(os.path.join(version_dir, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+
+        self.columns = {name: np.load(os.path.join(version_dir, name + '.npy'), mmap_mode='r')
+                        for name in COLUMNS + ['flags']}
+        self.partitions = np.load(os.path.join(version_dir, 'partitions.npy'))
+        self.offsets = np.load(os.path.join(version_dir, 'offsets.npy'))
+
+    def __len__(self):
+        return len(self.columns['productId'])
+
+    def partition(self, path, row):
+        # start and stop of the partition of a path/row in the columns
+        key = partition_key(path, row)
+        i = np.searchsorted(self.partitions, key)
+        if i == len(self.partitions) or self.partitions[i] != key:
+            return 0, 0
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def date_range(self, start, stop, starting_date=None, ending_date=None):
+        # narrow a partition to the scenes acquired on or after starting_date and before ending_date
+        # (same bounds as comparing the acquisitionDate strings with > starting_date and <= ending_date)
+        dates = self.columns['acquisitionDate'][start:stop]
+        first, last = 0, len(dates)
+        if starting_date is not None:
+            first = np.searchsorted(dates, np.datetime64(str(starting_date), 'us'), side='left')
+        if ending_date is not None:
+            last = np.searchsorted(dates, np.datetime64(str(ending_date), 'us'), side='left')
+        return start + int(first), start + max(int(first), int(last))
+
+    def indices(self, path, row, starting_date=None, ending_date=None, include_excluded=False):
+        # positions of the scenes of a path/row in the columns
+        start, stop = self.date_range(*self.partition(path, row), starting_date, ending_date)
+        indices = np.arange(start, stop)
+        if not include_excluded:
+            indices = indices[(self.columns['flags'][start:stop] & EXCLUDED) == 0]
+        return indices
+
+    def frame(self, indices):
+        # dataframe with the same columns as the scene list for the given positions
+        data = {}
+        for name in COLUMNS:
+            values = self.columns[name][indices]
+            if name in STRING_COLUMNS:
+                values = values.astype(str)
+            data[name] = values
+        return pd.DataFrame(data, columns=COLUMNS)
+
+    def scenes(self, path, row, starting_date=None, ending_date=None, include_excluded=False):
+        return self.frame(self.indices(path, row, starting_date, ending_date, include_excluded))
+
+    def indices_for_path_rows(self, list_of_path_and_rows, starting_date=None, ending_date=None):
+        indices = [self.indices(path, row, starting_date, ending_date) for path, row in list_of_path_and_rows]
+        return np.concatenate(indices) if indices else np.array([], dtype='int64')
+
+    def sort_indices(self, indices, sort='acquisitionDate'):
+        # positions sorted by one column of SORT_COLUMNS ('-<column>' for descending order), ties keep their order in
+        # the catalogue
+        name = sort[1:] if sort.startswith('-') else sort
+        if name not in SORT_COLUMNS:
+            raise ValueError('Cannot sort by {} (available: {})'.format(name, ', '.join(SORT_COLUMNS)))
+
+        keys = self.columns[name][indices]
+        if keys.dtype.kind == 'M':
+            keys = keys.view('int64')
+        if sort.startswith('-'):
+            keys = -keys
+        return indices[np.lexsort((indices, keys))]
+
+    def records(self, indices, fields=None):
+        # list of {column: value} for the positions, with only the given columns (all by default); only these rows of
+        # these columns are read
+        fields = fields or COLUMNS
+        unknown = [name for name in fields if name not in COLUMNS]
+        if unknown:
+            raise ValueError('Unknown fields: {} (available: {})'.format(', '.join(unknown), ', '.join(COLUMNS)))
+
+        values = {}
+        for name in fields:
+            column = self.columns[name][indices]
+            if name in STRING_COLUMNS:
+                column = np.char.decode(column, 'utf-8')
+            values[name] = column.tolist()
+        return [dict(zip(fields, row)) for row in zip(*(values[name] for name in fields))]
+
+    def scenes_for_path_rows(self, list_of_path_and_rows, starting_date=None, ending_date=None):
+        # scenes of all the path/rows, with a column telling to which path/row (position in the list) a scene belongs
+        indices = []
+        index_for_path_and_row = []
+        for i, (path, row) in enumerate(list_of_path_and_rows):
+            idx = self.indices(path, row, starting_date, ending_date)
+            indices.append(idx)
+            index_for_path_and_row.append(np.full(len(idx), i))
+
+        indices = np.concatenate(indices) if indices else np.array([], dtype='int64')
+        scenes = self.frame(indices)
+        scenes['index_for_path_and_row'] = (np.concatenate(index_for_path_and_row) if index_for_path_and_row
+                                            else np.array([], dtype='int64'))
+        return scenes
+
+
+_catalogue = None
+_catalogue_lock = threading.Lock()
+
+
+def current_version_dir(directory=None):
+    directory = directory or get_catalogue_dir()
+    try:
+        with open(os.path.join(directory, 'CURRENT')) as f:
+            return os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def get_catalogue():
+    # the catalogue is opened once per process, and reopened when a new version was written (e.g. by a refresh)
+    global _catalogue
+    with _catalogue_lock:
+        version_dir = current_version_dir()
+        if version_dir is None:
+            version_dir = build_catalogue()
+        if _catalogue is None or _catalogue.version_dir != version_dir:
+            _catalogue = SceneCatalogue(version_dir)
+        return _catalogue
@@ -0,0 +1,290 @@
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+# ------------------------------------------------------ Disk caches ---------------------------------------------------
+# Files kept on disk between the requests, in a directory with a size budget. When the budget is exceeded, the least
+# recently used files are removed (the modification time of a file is updated every time it is used). Files are
+# written to a temporary name first and then renamed, so a file in the cache is always complete. Temporary files which
+# were not written to for TMP_MAX_AGE seconds were left by a stopped process and are removed as well.
+
+TMP_MAX_AGE = 60 * 60
+
+
+def is_tmp(filename):
+    return filename.endswith('.tmp') or filename.endswith('.part')
+
+
+class DiskCache:
+    def __init__(self, root, max_bytes):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def get(self, *parts):
+        # path of the file if it is in the cache (and mark it as used), otherwise None
+        file_path = self.path(*parts)
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            return None
+        return file_path
+
+    def tmp_path(self, file_path):
+        # temporary file next to the final one (same file system, so it can be renamed atomically)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        return '{}.{}.tmp'.format(file_path, uuid.uuid4().hex)
+
+    def publish(self, tmp_path, file_path, keep=()):
+        # move a completely written file into the cache
+        os.replace(tmp_path, file_path)
+        self.evict(keep=set(keep) | {file_path})
+        return file_path
+
+    def scan(self):
+        # (modification time, size, path) of all the complete files in the cache, and the paths of the stale temporary
+        # files
+        files, stale = [], []
+        expired = time.time() - TMP_MAX_AGE
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                file_path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                if not is_tmp(filename):
+                    files.append((stat.st_mtime, stat.st_size, file_path))
+                elif stat.st_mtime < expired:
+                    stale.append(file_path)
+        return files, stale
+
+    def files(self):
+        return self.scan()[0]
+
+    def evict(self, keep=()):
+        # remove the stale temporary files, then the least recently used files until the cache fits into its budget,
+        # the files in keep are not removed
+        with self._lock:
+            files, stale = self.scan()
+            for file_path in stale:
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            for _, size, file_path in files:
+                if total <= self.max_bytes:
+                    break
+                if file_path in keep:
+                    continue
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+                # remove the directory of the file as well when it is empty
+                try:
+                    os.rmdir(os.path.dirname(file_path))
+                except OSError:
+                    pass
+
+
+class BandCache(DiskCache):
+    """Landsat band files, keyed by productId and file name (e.g. LC08_..._T1/LC08_..._T1_B4.TIF).
+
+    Masked versions of the bands are kept in a sub-directory named after the mask (e.g. LC08_..._T1/Austria/...)."""
+
+    def band_path(self, product_id, filename, mask=None):
+        if mask is None:
+            return self.path(product_id, filename)
+        return self.path(product_id, re.sub(r'[^0-9A-Za-z]+', '_', mask), filename)
+
+    def get_band(self, product_id, filename, mask=None):
+        return self.get(os.path.relpath(self.band_path(product_id, filename, mask), self.root))
+
+
+class MaskCache(DiskCache):
+    """Rasterized masks of the countries, bits packed along the rows (8 pixels per byte) in .npy files, keyed by
+    path/row and a hash of (country, CRS, transform, shape) (e.g. 190027/<key>.npy)."""
+
+    def mask_path(self, path_row, key):
+        return self.path(re.sub(r'[^0-9A-Za-z]+', '_', path_row), key + '.npy')
+
+    def get_mask(self, path_row, key):
+        return self.get(os.path.relpath(self.mask_path(path_row, key), self.root))
+
+
+class ResultCache(DiskCache):
+    """Results of the jobs (indicator rasters and image), one directory per key. A directory is published and evicted
+    as a whole, the least recently used directories are evicted first."""
+
+    def get_result(self, key):
+        # directory of the result if it is in the cache (and mark it as used), otherwise None
+        result_dir = self.path(key)
+        try:
+            os.utime(result_dir)
+        except FileNotFoundError:
+            return None
+        return result_dir
+
+    def tmp_dir(self, key):
+        tmp_dir = self.path('{}.{}.tmp'.format(key, uuid.uuid4().hex))
+        os.makedirs(tmp_dir)
+        return tmp_dir
+
+    def publish_result(self, tmp_dir, key):
+        # move a complete result into the cache (if the same result was published meanwhile, it is kept)
+        result_dir = self.path(key)
+        try:
+            os.rename(tmp_dir, result_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict_results(keep={result_dir})
+        return result_dir
+
+    def scan_results(self):
+        # (modification time, size, path) of all the complete results in the cache, and the stale temporary directories
+        results, stale = [], []
+        expired = time.time() - TMP_MAX_AGE
+        for element in os.listdir(self.root):
+            result_dir = self.path(element)
+            if not os.path.isdir(result_dir):
+                continue
+            try:
+                entries = [entry.stat() for entry in os.scandir(result_dir)]
+                if is_tmp(element):
+                    # a result is being written as long as one of its files is
+                    if max([os.stat(result_dir).st_mtime] + [stat.st_mtime for stat in entries]) < expired:
+                        stale.append(result_dir)
+                    continue
+                results.append((os.stat(result_dir).st_mtime, sum(stat.st_size for stat in entries), result_dir))
+            except FileNotFoundError:
+                continue
+        return results, stale
+
+    def results(self):
+        return self.scan_results()[0]
+
+    def evict_results(self, keep=()):
+        with self._lock:
+            results, stale = self.scan_results()
+            for tmp_dir in stale:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+            results.sort()
+            total = sum(size for _, size, _ in results)
+            for _, size, result_dir in results:
+                if total <= self.max_bytes:
+                    break
+                if result_dir in keep:
+                    continue
+                shutil.rmtree(result_dir, ignore_errors=True)
+                total -= size
+
+
+class TileCache(DiskCache):
+    """Rendered map tiles (PNG) of the results, keyed by the key of the result and z/x/y (e.g. <key>/12/2200/1430.png).
+    The tiles are small and many, so the budget is checked every EVICT_INTERVAL new tiles instead of every tile."""
+
+    EVICT_INTERVAL = 100
+
+    def __init__(self, root, max_bytes):
+        super().__init__(root, max_bytes)
+        self._new_tiles = 0
+
+    def tile_path(self, key, z, x, y):
+        return self.path(key, str(z), str(x), '{}.png'.format(y))
+
+    def get_tile(self, key, z, x, y):
+        # PNG of the tile if it is in the cache (and mark it as used), otherwise None
+        tile_path = self.get(os.path.relpath(self.tile_path(key, z, x, y), self.root))
+        if tile_path is None:
+            return None
+        try:
+            with open(tile_path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set_tile(self, key, z, x, y, png):
+        tile_path = self.tile_path(key, z, x, y)
+        tmp_path = self.tmp_path(tile_path)
+        with open(tmp_path, 'wb') as f:
+            f.write(png)
+        os.replace(tmp_path, tile_path)
+
+        with self._lock:
+            self._new_tiles += 1
+            evict = self._new_tiles % self.EVICT_INTERVAL == 0
+        if evict:
+            self.evict(keep={tile_path})
+        return tile_path
+
+
+_band_cache = None
+_band_cache_lock = threading.Lock()
+
+
+def get_band_cache():
+    global _band_cache
+    if _band_cache is None:
+        with _band_cache_lock:
+            if _band_cache is None:
+                _band_cache = BandCache(getattr(settings, 'BAND_CACHE_DIR', 'band_cache'),
+                                        getattr(settings, 'BAND_CACHE_MAX_BYTES', 20 * 1024 ** 3))
+    return _band_cache
+
+
+_mask_cache = None
+_mask_cache_lock = threading.Lock()
+
+
+def get_mask_cache():
+    global _mask_cache
+    if _mask_cache is None:
+        with _mask_cache_lock:
+            if _mask_cache is None:
+                _mask_cache = MaskCache(getattr(settings, 'MASK_CACHE_DIR', 'mask_cache'),
+                                        getattr(settings, 'MASK_CACHE_MAX_BYTES', 1024 ** 3))
+    return _mask_cache
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = ResultCache(getattr(settings, 'RESULT_CACHE_DIR', 'result_cache'),
+                                            getattr(settings, 'RESULT_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+    return _result_cache
+
+
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache():
+    global _tile_cache
+    if _tile_cache is None:
+        with _tile_cache_lock:
+            if _tile_cache is None:
+                _tile_cache = TileCache(getattr(settings, 'TILE_CACHE_DIR', 'tile_cache'),
+                                        getattr(settings, 'TILE_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+    return _tile_cache
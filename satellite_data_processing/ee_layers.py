@@ -0,0 +1,186 @@
+import collections
+import concurrent.futures
+import json
+import threading
+import time
+
+import folium
+from django.conf import settings
+
+# ------------------------------------------------ Earth Engine map layers ---------------------------------------------
+# The Earth Engine layers of the google_earth_engine map are the same for every request, only the tile url (with the
+# map id and its token) has to be requested from Earth Engine (getMapId). The tile urls are kept for
+# settings.EE_TILE_URL_TTL seconds, keyed by (asset, filters, vis_params), and refreshed in the background before they
+# expire, so the map is rendered without waiting for Earth Engine.
+# The Earth Engine module can be replaced (e.g. by a fake one in tests) with set_ee.
+
+EELayer = collections.namedtuple('EELayer', ['name', 'kind', 'asset', 'select', 'filters', 'vis_params'])
+
+IMAGE = 'image'
+IMAGE_COLLECTION = 'image_collection'
+FEATURE_COLLECTION = 'feature_collection'
+
+EE_LAYERS = [
+    EELayer(
+        name='JRC Surface Water',
+        kind=IMAGE,
+        asset='JRC/GSW1_1/GlobalSurfaceWater',
+        select='occurrence',
+        filters=(),
+        vis_params={
+            'min': 0.0,
+            'max': 100.0,
+            'palette': ['ffffff', 'ffbbbb', '0000ff'],
+        },
+    ),
+    EELayer(
+        name='NDVI',
+        kind=IMAGE_COLLECTION,
+        asset='LANDSAT/LC08/C01/T1_ANNUAL_NDVI',
+        select='NDVI',
+        filters=(('filterDate', ('2020-01-01', '2020-12-31')),),
+        vis_params={
+            'min': 0.0,
+            'max': 1.0,
+            'palette': ['FFFFFF', 'CE7E45', 'DF923D', 'F1B555', 'FCD163', '99B718', '74A901', '66A000', '529400',
+                        '3E8601', '207401', '056201', '004C00', '023B01', '012E01', '011D01', '011301'],
+        },
+    ),
+    EELayer(
+        name='NDWI',
+        kind=IMAGE_COLLECTION,
+        asset='LANDSAT/LC08/C01/T1_ANNUAL_NDWI',
+        select='NDWI',
+        filters=(('filterDate', ('2020-01-01', '2020-12-31')),),
+        vis_params={
+            'min': 0.0,
+            'max': 1.0,
+            'palette': ['0000ff', '00ffff', 'ffff00', 'ff0000', 'ffffff'],
+        },
+    ),
+    EELayer(
+        name='Boundaries',
+        kind=FEATURE_COLLECTION,
+        asset='USDOS/LSIB_SIMPLE/2017',
+        select=None,
+        filters=(),
+        vis_params={},
+    ),
+]
+
+_ee = None
+_ee_lock = threading.Lock()
+
+
+def get_ee():
+    # the Earth Engine module, initialized on first use
+    global _ee
+    if _ee is None:
+        with _ee_lock:
+            if _ee is None:
+                import ee
+                ee.Initialize()
+                _ee = ee
+    return _ee
+
+
+def set_ee(ee):
+    # use another (already initialized) Earth Engine module, e.g. a fake one in tests
+    global _ee
+    _ee = ee
+    clear_tile_urls()
+
+
+def layer_key(layer):
+    return json.dumps([layer.kind, layer.asset, layer.select, layer.filters, layer.vis_params], sort_keys=True)
+
+
+def layer_image(layer):
+    # the ee.Image displayed for a layer
+    ee = get_ee()
+    if layer.kind == IMAGE:
+        image = ee.Image(layer.asset)
+    elif layer.kind == IMAGE_COLLECTION:
+        image = ee.ImageCollection(layer.asset)
+    elif layer.kind == FEATURE_COLLECTION:
+        return ee.Image().paint(ee.FeatureCollection(layer.asset), 0, 2)
+    else:
+        raise ValueError('Unknown kind of Earth Engine layer: {}'.format(layer.kind))
+
+    for method, args in layer.filters:
+        image = getattr(image, method)(*args)
+    if layer.select is not None:
+        image = image.select(layer.select)
+    if layer.kind == IMAGE_COLLECTION:
+        image = image.mosaic()
+    return image
+
+
+def fetch_tile_url(layer):
+    # request a new map id from Earth Engine
+    map_id_dict = get_ee().Image(layer_image(layer)).getMapId(layer.vis_params)
+    return map_id_dict['tile_fetcher'].url_format
+
+
+# key of a layer -> (tile url, time when it was fetched)
+_tile_urls = {}
+_refreshing = set()
+_tile_urls_lock = threading.Lock()
+_refresh_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ee-refresh')
+
+
+def clear_tile_urls():
+    with _tile_urls_lock:
+        _tile_urls.clear()
+
+
+def _refresh(key, layer):
+    try:
+        url = fetch_tile_url(layer)
+        with _tile_urls_lock:
+            _tile_urls[key] = (url, time.monotonic())
+    except Exception as e:
+        print("Could not refresh {}: {}".format(layer.name, e))
+    finally:
+        with _tile_urls_lock:
+            _refreshing.discard(key)
+
+
+def get_tile_url(layer):
+    # tile url of a layer; fetched from Earth Engine only the first time or when it is expired, and refreshed in the
+    # background when it is about to expire (after settings.EE_TILE_URL_REFRESH of its lifetime)
+    ttl = getattr(settings, 'EE_TILE_URL_TTL', 60 * 60 * 4)
+    refresh_after = ttl * getattr(settings, 'EE_TILE_URL_REFRESH', 0.75)
+    key = layer_key(layer)
+
+    with _tile_urls_lock:
+        url, fetched = _tile_urls.get(key, (None, None))
+        age = time.monotonic() - fetched if fetched is not None else None
+        if age is not None and refresh_after <= age < ttl and key not in _refreshing:
+            _refreshing.add(key)
+            _refresh_pool.submit(_refresh, key, layer)
+
+    if age is not None and age < ttl:
+        return url
+
+    url = fetch_tile_url(layer)
+    with _tile_urls_lock:
+        _tile_urls[key] = (url, time.monotonic())
+    return url
+
+
+def add_ee_layers(m, layers=EE_LAYERS):
+    # add the Earth Engine layers to a folium map
+    for layer in layers:
+        try:
+            folium.raster_layers.TileLayer(
+                tiles=get_tile_url(layer),
+                attr='Google Earth Engine',
+                name=layer.name,
+                overlay=True,
+                control=True,
+                show=False,
+            ).add_to(m)
+        except Exception:
+            print("Could not display {}".format(layer.name))
+
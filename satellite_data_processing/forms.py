@@ -32,9 +32,20 @@ class IndicatorChoiceForm(forms.ModelForm):
             ('NDWI', 'Normalized Difference Water Index'),
             ('NDSI', 'Normalized Difference Soil Index'),
             ('NDRE', 'Normalized Difference Red Edge'),
-            ('SLAVI', 'Specific Leaf Area Vegetation Index')
+            ('SLAVI', 'Specific Leaf Area Vegetation Index'),
+            ('EVI', 'Enhanced Vegetation Index')
         ]
 
         widgets = {
             'indicator': forms.Select(choices=CHOICES, attrs={'class': 'form-control'}),
         }
+
+
+class AutoSelectForm(forms.Form):
+    max_cloud_cover = forms.FloatField(min_value=0, max_value=100, required=False, initial=30,
+                                       label='Maximum cloud cover (%)')
+
+
+class TimeSeriesForm(forms.Form):
+    max_cloud_cover = forms.FloatField(min_value=0, max_value=100, required=False, initial=30,
+                                       label='Maximum cloud cover (%)')
@@ -0,0 +1,97 @@
+import hashlib
+import threading
+
+from django.core.cache import cache
+from django.db import IntegrityError
+
+from .models import Geocode
+
+# ------------------------------------------------------ Geocoding -----------------------------------------------------
+# Place names entered by the users are geocoded once: the results are kept in the Geocode table of the database
+# (persistent) and in the default cache (in memory, least recently used entries are removed first), so a place which
+# was already searched never calls the geocoder (Nominatim) again. Places which were not found are kept as well.
+# The geocoder can be replaced (e.g. by a stub in tests) with set_geocoder.
+
+USER_AGENT = 'satellite_data_processing'
+
+# places are kept in the default cache for a day (and in the database forever)
+GEOCODE_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+class Place:
+    # result of the geocoder: the same attributes as the locations of geopy
+    def __init__(self, address, latitude, longitude):
+        self.address = address
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def __str__(self):
+        return self.address
+
+    def __repr__(self):
+        return 'Place({!r}, {}, {})'.format(self.address, self.latitude, self.longitude)
+
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+
+
+def get_geocoder():
+    global _geocoder
+    if _geocoder is None:
+        with _geocoder_lock:
+            if _geocoder is None:
+                from geopy.geocoders import Nominatim
+                _geocoder = Nominatim(user_agent=USER_AGENT)
+    return _geocoder
+
+
+def set_geocoder(geocoder):
+    # any object with a geocode(query) method returning None or an object with address, latitude and longitude
+    global _geocoder
+    _geocoder = geocoder
+
+
+def normalize_query(query):
+    # 'Vienna', ' vienna ' and 'VIENNA' are the same place
+    return ' '.join(str(query).split()).casefold()
+
+
+def _cache_key(query):
+    return 'geocode:{}'.format(hashlib.sha1(query.encode('utf-8')).hexdigest())
+
+
+def _place(row):
+    if not row.found:
+        return None
+    return Place(row.address, row.latitude, row.longitude)
+
+
+def geocode(query):
+    # Place of a place name (None if it does not exist), from the cache, the database or the geocoder
+    query = normalize_query(query)
+    if not query:
+        return None
+
+    key = _cache_key(query)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached or None
+
+    row = Geocode.objects.filter(query=query).first()
+    if row is None:
+        location = get_geocoder().geocode(query)
+        row = Geocode(query=query, found=location is not None)
+        if location is not None:
+            row.address = str(location.address)
+            row.latitude = location.latitude
+            row.longitude = location.longitude
+        try:
+            row.save()
+        except IntegrityError:
+            # the same place was geocoded by another request meanwhile
+            row = Geocode.objects.get(query=query)
+
+    place = _place(row)
+    cache.set(key, place or False, GEOCODE_CACHE_TIMEOUT)
+    return place
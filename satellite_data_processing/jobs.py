@@ -0,0 +1,186 @@
+import concurrent.futures
+import datetime
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import traceback
+
+import pandas as pd
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .disk_cache import get_result_cache
+from .models import Job
+
+# -------------------------------------------------------- Jobs --------------------------------------------------------
+# The processing of the selected scenes (download, masking, indicator computation and plotting) takes minutes, so it is
+# not done inside the request: the aws view enqueues a job (a row of the Job table in the sqlite database) and a pool of
+# background threads of the web server executes it. The stage and percentage of the job are updated in the database,
+# the aws_img page polls them through the job_status view. No external broker is needed.
+# The jobs of a stopped server are recovered when the pool is started: the queued jobs are submitted again, the running
+# ones without progress for settings.JOB_TIMEOUT seconds are failed.
+# The results (indicator rasters and image) are kept in the result cache, keyed by the selected scenes, the mask
+# geometry and the indicator, so a job which was already computed is done right away.
+# A job either creates the image of the indicator (Job.IMAGE) or the time series of its statistics over the location,
+# one row per date, as JSON and CSV (Job.STATISTICS, see zonal.py).
+
+# names of the files in the directory of a result
+RESULT_IMAGE = 'plot.png'
+RESULT_FILES = {
+    'png': RESULT_IMAGE,
+    'json': 'statistics.json',
+    'csv': 'statistics.csv',
+}
+
+_job_pool = None
+_job_pool_lock = threading.Lock()
+
+
+def get_job_pool():
+    global _job_pool
+    if _job_pool is None:
+        with _job_pool_lock:
+            if _job_pool is None:
+                _job_pool = concurrent.futures.ThreadPoolExecutor(max_workers=getattr(settings, 'JOB_WORKERS', 2),
+                                                                  thread_name_prefix='job')
+                recover_jobs(_job_pool)
+    return _job_pool
+
+
+def fail_stale_jobs():
+    # the running jobs without progress for settings.JOB_TIMEOUT seconds are failed (their thread is gone)
+    timeout = datetime.timedelta(seconds=getattr(settings, 'JOB_TIMEOUT', 60 * 60))
+    return Job.objects.filter(state=Job.RUNNING, updated__lt=timezone.now() - timeout).update(
+        state=Job.FAILED, error='The job was interrupted', updated=timezone.now())
+
+
+def recover_jobs(pool):
+    # jobs left by a previous run of the server: the queued jobs are submitted again (a job is only run once, even if
+    # it is submitted by several processes) and the stale running jobs are failed
+    fail_stale_jobs()
+    for job_id in Job.objects.filter(state=Job.QUEUED).values_list('id', flat=True):
+        pool.submit(run_job, job_id)
+
+
+def geometry_digest(location):
+    # the mask is the shape of the country in countries.geojson, identified by its name and the version of the file
+    try:
+        stat = os.stat('countries.geojson')
+        version = [stat.st_size, stat.st_mtime_ns]
+    except FileNotFoundError:
+        version = None
+    return [location, version]
+
+
+def result_key(scenes, location, indicator, kind=Job.IMAGE):
+    # key of the result of a job in the result cache
+    key = {
+        'scenes': sorted(scenes['productId']),
+        'geometry': geometry_digest(location),
+        'indicator': indicator,
+    }
+    if kind != Job.IMAGE:
+        key['kind'] = kind
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def get_result_file(key, format):
+    # path of a file of a result (png, json or csv), None if it is not (anymore) in the cache
+    result_dir = get_result_cache().get_result(key)
+    if result_dir is None or format not in RESULT_FILES:
+        return None
+    return os.path.join(result_dir, RESULT_FILES[format])
+
+
+def get_result_image(key):
+    # path of the image of a result, None if it is not (anymore) in the cache
+    return get_result_file(key, 'png')
+
+
+def enqueue_job(scenes, location, indicator, kind=Job.IMAGE):
+    # create the job and start it in the background (unless its result is already in the cache), returns the job
+    key = result_key(scenes, location, indicator, kind)
+    scenes = scenes.to_json(orient='records', date_format='iso')
+
+    if get_result_cache().get_result(key) is not None:
+        return Job.objects.create(location=location, indicator=indicator, kind=kind, scenes=scenes, result=key,
+                                  state=Job.DONE, stage='Done', percent=100)
+
+    job = Job.objects.create(location=location, indicator=indicator, kind=kind, scenes=scenes, result=key)
+    get_job_pool().submit(run_job, job.id)
+    return job
+
+
+def set_progress(job_id, stage, percent, **fields):
+    # update() does not set the auto_now fields, updated is the time of the last progress (see fail_stale_jobs)
+    Job.objects.filter(id=job_id).update(stage=stage, percent=percent, updated=timezone.now(), **fields)
+
+
+def job_scenes(job):
+    return pd.read_json(io.StringIO(job.scenes), orient='records')
+
+
+def run_image_job(job, output_dir):
+    from .pipeline import submit_scenes
+    from .utils import plotting_image
+
+    scenes = job_scenes(job)
+
+    # every scene is downloaded, masked and computed in the process pool, 0-90% when all the scenes are done
+    set_progress(job.id, 'Processing scenes', 0)
+    futures = submit_scenes(scenes, job.location, [job.indicator], output_dir)
+    outputs = []
+    for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+        outputs.extend(future.result()[job.indicator])
+        set_progress(job.id, 'Processing scenes ({}/{})'.format(n, len(futures)), 90 * n // len(futures))
+
+    set_progress(job.id, 'Creating the image', 90)
+    plotting_image(job.location, sorted(outputs), os.path.join(output_dir, RESULT_IMAGE))
+
+
+def run_statistics_job(job, output_dir):
+    from .zonal import time_series, write_time_series
+
+    scenes = job_scenes(job)
+
+    # the scenes of all the dates are processed in parallel in the process pool, 0-95% when all the scenes are done
+    def progress(done, total):
+        set_progress(job.id, 'Processing scenes ({}/{})'.format(done, total), 95 * done // total)
+
+    set_progress(job.id, 'Processing scenes', 0)
+    rows = time_series(scenes, job.location, job.indicator, progress)
+
+    set_progress(job.id, 'Writing the statistics', 95)
+    write_time_series(rows, os.path.join(output_dir, RESULT_FILES['json']),
+                      os.path.join(output_dir, RESULT_FILES['csv']), location=job.location, indicator=job.indicator)
+
+
+def run_job(job_id):
+    # take the job (only once, even if it was submitted several times)
+    if not Job.objects.filter(id=job_id, state=Job.QUEUED).update(state=Job.RUNNING, updated=timezone.now()):
+        return
+
+    job = Job.objects.get(id=job_id)
+    cache = get_result_cache()
+    output_dir = cache.tmp_dir(job.result)
+    try:
+        if job.kind == Job.STATISTICS:
+            run_statistics_job(job, output_dir)
+        else:
+            run_image_job(job, output_dir)
+        cache.publish_result(output_dir, job.result)
+
+        set_progress(job_id, 'Done', 100, state=Job.DONE)
+
+    except Exception as e:
+        traceback.print_exc()
+        Job.objects.filter(id=job_id).update(state=Job.FAILED, error=str(e), updated=timezone.now())
+
+    finally:
+        # deleting the files of a job which did not finish
+        shutil.rmtree(output_dir, ignore_errors=True)
+        connection.close()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from satellite_data_processing.catalogue import (CatalogueError, build_catalogue, get_scene_list_path,
+                                                 refresh_catalogue)
+
+
+class Command(BaseCommand):
+    help = "Ingest the rows appended to the scene list (scene_list.gz) since the last refresh into the scene catalogue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=None,
+                            help="Path of the scene list (default: settings.SCENE_LIST)")
+        parser.add_argument('--full', action='store_true',
+                            help="Rebuild the whole catalogue instead of ingesting only the new rows")
+
+    def handle(self, *args, **options):
+        source = options['source'] or get_scene_list_path()
+
+        if options['full']:
+            version_dir = build_catalogue(source)
+            self.stdout.write(self.style.SUCCESS("Scene catalogue rebuilt: {}".format(version_dir)))
+            return
+
+        try:
+            version_dir, new_rows = refresh_catalogue(source)
+        except CatalogueError as e:
+            raise CommandError("{} (run the command with --full)".format(e))
+
+        if new_rows is None:
+            self.stdout.write(self.style.SUCCESS("Scene catalogue built: {}".format(version_dir)))
+        else:
+            self.stdout.write(self.style.SUCCESS("{} new scenes ingested: {}".format(new_rows, version_dir)))
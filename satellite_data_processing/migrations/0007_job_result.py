@@ -0,0 +1,18 @@
+# Generated by Django 3.2.1 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('satellite_data_processing', '0006_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='result',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
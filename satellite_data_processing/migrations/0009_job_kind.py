@@ -0,0 +1,18 @@
+# Generated by Django 3.2.1 on 2026-10-18 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('satellite_data_processing', '0008_geocode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('image', 'Image'), ('statistics', 'Statistics')], default='image', max_length=10),
+        ),
+    ]
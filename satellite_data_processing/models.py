@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 
 
@@ -8,3 +10,48 @@ class Location(models.Model):
 class Indicator(models.Model):
     indicator = models.CharField(max_length=100, blank=True)
 
+
+
+class Job(models.Model):
+    # processing of the scenes selected by a user, executed in the background (see jobs.py)
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    # kinds of jobs: an image of the indicator (with its rasters) or the time series of its statistics (see zonal.py)
+    IMAGE = 'image'
+    STATISTICS = 'statistics'
+    KINDS = [
+        (IMAGE, 'Image'),
+        (STATISTICS, 'Statistics'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    location = models.CharField(max_length=100)
+    indicator = models.CharField(max_length=100)
+    kind = models.CharField(max_length=10, choices=KINDS, default=IMAGE)
+    scenes = models.TextField()  # selected scenes as json records
+    state = models.CharField(max_length=10, choices=STATES, default=QUEUED)
+    stage = models.CharField(max_length=100, blank=True)
+    percent = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    result = models.CharField(max_length=64, blank=True)  # key of the result in the result cache
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class Geocode(models.Model):
+    # result of the geocoder for a place name (see geocoding.py), not found places are kept as well
+    query = models.CharField(max_length=255, unique=True)  # normalized place name
+    found = models.BooleanField(default=True)
+    address = models.TextField(blank=True)
+    latitude = models.FloatField(null=True)
+    longitude = models.FloatField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
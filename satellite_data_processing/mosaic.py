@@ -0,0 +1,173 @@
+import collections
+import math
+import struct
+import zlib
+
+import numpy as np
+import rasterio
+import rasterio.features
+import rasterio.warp
+import rasterio.windows
+from rasterio.enums import Resampling
+from rasterio.transform import Affine, from_origin
+
+# ---------------------------------------------------- Mosaic images ---------------------------------------------------
+# The indicator rasters of all the scenes are merged into one image: the rasters are read at the resolution of the image
+# (from their overviews when they have some, otherwise decimated by GDAL while reading), reprojected into one shared
+# grid in the CRS of the scenes, coloured with a lookup table and written as PNG directly, without matplotlib figures.
+
+# largest side of the mosaic image in pixels
+MOSAIC_MAX_SIZE = 2048
+
+# viridis colour map, interpolated between these colours (position, (r, g, b))
+VIRIDIS = [
+    (0.0, (68, 1, 84)),
+    (0.125, (71, 44, 122)),
+    (0.25, (59, 81, 139)),
+    (0.375, (44, 113, 142)),
+    (0.5, (33, 144, 141)),
+    (0.625, (39, 173, 129)),
+    (0.75, (92, 200, 99)),
+    (0.875, (170, 220, 50)),
+    (1.0, (253, 231, 37)),
+]
+
+# colour of the outline of the location (r, g, b, a)
+OUTLINE_COLOUR = (255, 255, 255, 255)
+
+
+def colour_lut(anchors=VIRIDIS, size=256):
+    # (size, 4) uint8 table of RGBA colours, the colours are interpolated between the anchors
+    positions = np.array([position for position, _ in anchors])
+    colours = np.array([colour for _, colour in anchors], dtype='float64')
+    x = np.linspace(0, 1, size)
+
+    lut = np.full((size, 4), 255, dtype='uint8')
+    for channel in range(3):
+        lut[:, channel] = np.round(np.interp(x, positions, colours[:, channel]))
+    return lut
+
+
+def mosaic_grid(sources, max_size=MOSAIC_MAX_SIZE):
+    # Grid of the mosaic: the CRS of most of the scenes (the UTM zone of the area), the union of the bounds of all the
+    # scenes and the native resolution, reduced so that the largest side is at most max_size pixels.
+    # Returns (crs, transform, width, height).
+    crs = collections.Counter(src.crs for src in sources).most_common(1)[0][0]
+
+    bounds = [rasterio.warp.transform_bounds(src.crs, crs, *src.bounds) for src in sources]
+    left, bottom = min(b[0] for b in bounds), min(b[1] for b in bounds)
+    right, top = max(b[2] for b in bounds), max(b[3] for b in bounds)
+
+    resolution = min(abs(src.res[0]) for src in sources)
+    resolution = max(resolution, (right - left) / max_size, (top - bottom) / max_size)
+
+    width = max(1, math.ceil((right - left) / resolution))
+    height = max(1, math.ceil((top - bottom) / resolution))
+    return crs, from_origin(left, top, resolution, resolution), width, height
+
+
+def read_decimated(src, resolution):
+    # first band of the raster at about the given resolution (never finer than the raster), and its transform
+    factor = max(1.0, resolution / abs(src.res[0]))
+    height = max(1, int(src.height / factor))
+    width = max(1, int(src.width / factor))
+
+    data = src.read(1, out_shape=(height, width), resampling=Resampling.nearest).astype('float32', copy=False)
+    transform = src.transform * Affine.scale(src.width / width, src.height / height)
+    return data, transform
+
+
+def merge_rasters(image_paths, max_size=MOSAIC_MAX_SIZE):
+    # Mosaic of the rasters (nan where there is no data, the later rasters are drawn over the earlier ones).
+    # Returns (data, crs, transform).
+    sources = [rasterio.open(image_path) for image_path in image_paths]
+    try:
+        crs, transform, width, height = mosaic_grid(sources, max_size)
+        resolution = transform.a
+        mosaic = np.full((height, width), np.nan, dtype='float32')
+
+        for src in sources:
+            data, src_transform = read_decimated(src, resolution)
+            if src.nodata is not None and not np.isnan(src.nodata):
+                data[data == src.nodata] = np.nan
+
+            # part of the mosaic covered by the raster
+            bounds = rasterio.warp.transform_bounds(src.crs, crs, *src.bounds)
+            window = rasterio.windows.from_bounds(*bounds, transform=transform)
+            window = window.round_offsets().round_lengths()
+            window = window.intersection(rasterio.windows.Window(0, 0, width, height))
+
+            part = np.full((window.height, window.width), np.nan, dtype='float32')
+            rasterio.warp.reproject(data, part,
+                                    src_crs=src.crs, src_transform=src_transform, src_nodata=np.nan,
+                                    dst_crs=crs, dst_transform=rasterio.windows.transform(window, transform),
+                                    dst_nodata=np.nan, resampling=Resampling.nearest)
+
+            target = mosaic[window.toslices()]
+            np.copyto(target, part, where=~np.isnan(part))
+    finally:
+        for src in sources:
+            src.close()
+
+    return mosaic, crs, transform
+
+
+def colourize(data, vmin=None, vmax=None, lut=None):
+    # RGBA image of the values, scaled from vmin to vmax (by default the range of the values), nan is transparent
+    if lut is None:
+        lut = colour_lut()
+    valid = ~np.isnan(data)
+    if vmin is None:
+        vmin = float(data[valid].min()) if valid.any() else 0.0
+    if vmax is None:
+        vmax = float(data[valid].max()) if valid.any() else 1.0
+    scale = (len(lut) - 1) / (vmax - vmin) if vmax > vmin else 0.0
+
+    index = np.zeros(data.shape, dtype='float32')
+    np.subtract(data, vmin, out=index, where=valid)
+    np.multiply(index, scale, out=index)
+    np.clip(index, 0, len(lut) - 1, out=index)
+
+    rgba = lut[index.astype('uint8')]
+    rgba[~valid, 3] = 0
+    return rgba
+
+
+def encode_png(rgba, level=1):
+    # PNG file (bytes) of an RGBA image of shape (height, width, 4), a low compression level is much faster for a
+    # slightly larger file
+    height, width, channels = rgba.shape
+
+    # every row starts with its filter type (0: none)
+    raw = np.zeros((height, width * channels + 1), dtype='uint8')
+    raw[:, 1:] = rgba.reshape(height, width * channels)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return b''.join([b'\x89PNG\r\n\x1a\n',
+                     chunk(b'IHDR', header),
+                     chunk(b'IDAT', zlib.compress(raw.tobytes(), level)),
+                     chunk(b'IEND', b'')])
+
+
+def render_mosaic(image_paths, output_path, outline=None, max_size=MOSAIC_MAX_SIZE, vmin=None, vmax=None):
+    # Write the PNG mosaic of the rasters to output_path. outline is an optional GeoSeries (e.g. the shape of the
+    # location) whose boundary is drawn over the image.
+    if not image_paths:
+        raise ValueError('No images to plot')
+
+    data, crs, transform = merge_rasters(image_paths, max_size)
+    rgba = colourize(data, vmin, vmax)
+
+    if outline is not None and len(outline):
+        boundaries = [geometry.boundary for geometry in outline.to_crs(crs).geometry if not geometry.is_empty]
+        if boundaries:
+            lines = rasterio.features.rasterize(boundaries, out_shape=data.shape, transform=transform,
+                                                all_touched=True, dtype='uint8').astype(bool)
+            rgba[lines] = OUTLINE_COLOUR
+
+    with open(output_path, 'wb') as f:
+        f.write(encode_png(rgba))
+    return output_path
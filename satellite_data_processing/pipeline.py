@@ -0,0 +1,51 @@
+import concurrent.futures
+import os
+import threading
+
+from django.conf import settings
+
+# ----------------------------------------------- Per-scene processing pipeline ----------------------------------------
+# Every scene goes through download -> masking -> indicator computation on its own, in a pool of worker processes.
+# So one scene can be masked while another one is downloaded and a third one computes its indicator, on different
+# cores, instead of every step waiting for all the scenes of the previous step. The mosaic only waits for the outputs
+# it needs.
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    # the worker processes need the django settings and apps (e.g. for the band cache)
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def get_process_pool():
+    # one pool of worker processes shared by all the requests of the process
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                max_workers = getattr(settings, 'PIPELINE_WORKERS', None) or os.cpu_count()
+                _process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                                       initializer=_init_worker)
+    return _process_pool
+
+
+def process_scene(scene, location, indicators, output_dir, number):
+    # download, mask and compute the indicators of one scene (a dataframe with one row), in a worker process
+    from .utils import band_file_suffixes, compute_indicator, get_bands_data, mask_bands
+
+    bands = get_bands_data(scene, band_file_suffixes(indicators), max_workers=len(band_file_suffixes(indicators)))
+    masked_bands = mask_bands(location, bands)
+    return compute_indicator(masked_bands, indicators, output_dir=output_dir, start=number)
+
+
+def submit_scenes(scenes, location, indicators, output_dir='./L8_raw_data'):
+    # start the pipeline of every scene, returns one future per scene (resolving to {indicator: [paths]})
+    pool = get_process_pool()
+    return [pool.submit(process_scene, scenes.iloc[[k]], location, indicators, output_dir, k + 1)
+            for k in range(len(scenes))]
+
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+from django.core.cache import caches
+
+# -------------------------------------------- Scene selection state per user ------------------------------------------
+# The scenes found for a location, the scenes selected by the user, the location and the indicator are kept in a cache
+# (settings.CACHES['scene_selection']) under the session key of the user, instead of csv files in the working directory
+# and the last rows of the database. Every user (and every job) has its own entry, so concurrent users do not overwrite
+# each other's selection. The dataframes are stored as compact numpy record arrays.
+
+SELECTION_CACHE = 'scene_selection'
+
+
+def get_selection_cache():
+    return caches[SELECTION_CACHE]
+
+
+def frame_to_records(frame):
+    # strings are stored as fixed width bytes instead of python objects
+    frame = frame.copy()
+    for name in frame.columns:
+        if not (pd.api.types.is_numeric_dtype(frame[name]) or pd.api.types.is_datetime64_any_dtype(frame[name])):
+            frame[name] = frame[name].astype(str).to_numpy().astype('S')
+    return frame.to_records(index=False)
+
+
+def records_to_frame(records):
+    frame = pd.DataFrame.from_records(records)
+    for name in frame.columns:
+        if records.dtype[name].kind == 'S':
+            frame[name] = frame[name].str.decode('utf-8').astype(object)
+    return frame
+
+
+def get_selection_key(request):
+    # the session has to be saved once to get a key
+    if request.session.session_key is None:
+        request.session.save()
+    return 'selection:{}'.format(request.session.session_key)
+
+
+def load_selection(key):
+    # dict with the stored state, the dataframes are converted back from record arrays
+    state = get_selection_cache().get(key) or {}
+    return {name: records_to_frame(value) if isinstance(value, np.recarray) else value
+            for name, value in state.items()}
+
+
+def save_selection(key, **values):
+    # update the stored state with the given values, dataframes are converted to record arrays
+    cache = get_selection_cache()
+    state = cache.get(key) or {}
+    for name, value in values.items():
+        state[name] = frame_to_records(value) if isinstance(value, pd.DataFrame) else value
+    cache.set(key, state)
@@ -1,3 +1,989 @@
-from django.test import TestCase
+import concurrent.futures
+import datetime
+import gzip
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import requests
+import shapely
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import catalogue, geocoding, jobs, tiles, utils, zonal
+from .disk_cache import BandCache, MaskCache, ResultCache, TileCache
+from .models import Geocode, Job
+
+
+# -------------------------------------------------------- Jobs --------------------------------------------------------
+class ImmediatePool:
+    # job pool running the submitted jobs right away, in the calling thread
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args)
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def done_future(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+# run_job closes the database connection of its thread when it is done, so the jobs are tested outside of a transaction
+class JobTests(TransactionTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.cache = ResultCache(self.root, 1024 ** 3)
+        self.pool = ImmediatePool()
+        for name, value in [('get_result_cache', lambda: self.cache), ('get_job_pool', lambda: self.pool)]:
+            patcher = mock.patch.object(jobs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.scenes = pd.DataFrame({
+            'productId': ['LC08_L1TP_190027_20200101_20200113_01_T1', 'LC08_L1TP_191027_20200101_20200113_01_T1'],
+            'acquisitionDate': ['2020-01-01 10:00:00', '2020-01-01 10:00:30'],
+        })
+        self.states = []
+
+    def submit_scenes(self, scenes, location, indicators, output_dir):
+        # outputs of the scenes, the state of the job is recorded while the scenes are processed
+        self.states.append(Job.objects.get().state)
+        return [done_future({indicators[0]: [os.path.join(output_dir, 'OUTPUT{}.tiff'.format(k + 1))]})
+                for k in range(len(scenes))]
+
+    def plotting_image(self, location, image_paths, output_path):
+        with open(output_path, 'wb') as f:
+            f.write(b'png')
+        return output_path
+
+    def enqueue(self):
+        with mock.patch('satellite_data_processing.pipeline.submit_scenes', self.submit_scenes), \
+                mock.patch.object(utils, 'plotting_image', self.plotting_image):
+            job = jobs.enqueue_job(self.scenes, 'Austria', 'NDVI')
+        return Job.objects.get(id=job.id)
+
+    def test_job_is_done(self):
+        job = self.enqueue()
+
+        self.assertEqual(self.states, [Job.RUNNING])
+        self.assertEqual((job.state, job.stage, job.percent, job.error), (Job.DONE, 'Done', 100, ''))
+        self.assertEqual(job.result, jobs.result_key(self.scenes, 'Austria', 'NDVI'))
+        with open(jobs.get_result_image(job.result), 'rb') as f:
+            self.assertEqual(f.read(), b'png')
+
+    def test_failed_job(self):
+        def fail(*args):
+            raise IOError('no connection')
+
+        self.submit_scenes = fail
+        job = self.enqueue()
+
+        self.assertEqual((job.state, job.error), (Job.FAILED, 'no connection'))
+        self.assertIsNone(jobs.get_result_image(job.result))
+        # the files of the job are removed
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_cached_result_is_done_right_away(self):
+        first = self.enqueue()
+        second = self.enqueue()
+
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual((second.state, second.result), (Job.DONE, first.result))
+        self.assertEqual(len(self.pool.submitted), 1)
+
+    def test_job_is_run_once(self):
+        job = self.enqueue()
+        Job.objects.filter(id=job.id).update(stage='Kept')
+
+        jobs.run_job(job.id)
+        self.assertEqual(Job.objects.get(id=job.id).stage, 'Kept')
+
+
+class RecordingPool:
+    # job pool which only records the submitted jobs
+    def __init__(self, *args, **kwargs):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args)
+
+
+class JobRecoveryTests(TestCase):
+    def setUp(self):
+        # a new pool (of this process) is started by the tests
+        for patcher in [mock.patch.object(jobs, '_job_pool', None),
+                        mock.patch.object(jobs.concurrent.futures, 'ThreadPoolExecutor', RecordingPool)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.queued = Job.objects.create(location='Austria', indicator='NDVI', scenes='[]')
+        self.running = Job.objects.create(location='Austria', indicator='NDVI', scenes='[]', state=Job.RUNNING)
+        self.stale = Job.objects.create(location='Austria', indicator='NDVI', scenes='[]', state=Job.RUNNING)
+        Job.objects.filter(id=self.stale.id).update(updated=timezone.now() - datetime.timedelta(hours=2))
+
+    def test_jobs_are_recovered_when_the_pool_starts(self):
+        pool = jobs.get_job_pool()
+
+        self.assertEqual(pool.submitted, [(self.queued.id,)])
+        self.assertEqual(Job.objects.get(id=self.running.id).state, Job.RUNNING)
+        stale = Job.objects.get(id=self.stale.id)
+        self.assertEqual((stale.state, stale.error), (Job.FAILED, 'The job was interrupted'))
+
+        # only once per process
+        self.assertIs(jobs.get_job_pool(), pool)
+        self.assertEqual(len(pool.submitted), 1)
+
+    def test_job_status_of_an_interrupted_job(self):
+        response = self.client.get(reverse('job_status', args=[self.stale.id]))
+        self.assertEqual(response.json()['state'], Job.FAILED)
+
+        response = self.client.get(reverse('job_status', args=[self.queued.id]))
+        self.assertEqual(response.json()['state'], Job.QUEUED)
+        self.assertEqual(jobs.get_job_pool().submitted, [(self.queued.id,)])
+
+
+# --------------------------------------------------- Scene catalogue --------------------------------------------------
+def scene_row(product_id, acquisition_date, cloud_cover=10.0):
+    # row of the scene list for a productId (e.g. LC08_L1TP_190027_20200101_20200113_01_T1)
+    path_row = product_id.split('_')[2]
+    return [product_id, 'LC8{}2020001LGN00'.format(path_row), acquisition_date, cloud_cover, 'L1TP', int(path_row[:3]),
+            int(path_row[3:]), 47.0, 14.0, 49.0, 17.0, 'https://landsat-pds.s3.amazonaws.com/{}/index.html'.format(
+                product_id)]
+
+
+def write_scene_list(file_path, rows):
+    pd.DataFrame(rows, columns=catalogue.COLUMNS).to_csv(file_path, index=False, compression='gzip')
+
+
+class CatalogueTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.source = os.path.join(self.directory, 'scene_list.gz')
+        self.catalogue_dir = os.path.join(self.directory, 'catalogue')
+
+    def scenes(self, path, row):
+        scenes = catalogue.SceneCatalogue(catalogue.current_version_dir(self.catalogue_dir)).scenes(
+            path, row, include_excluded=True)
+        return list(zip(scenes['productId'], scenes['acquisitionDate']))
+
+    def test_dates_with_and_without_fractional_seconds(self):
+        write_scene_list(self.source, [
+            scene_row('LC08_L1TP_190027_20150101_20170414_01_T1', '2015-01-01 10:00:00'),
+            scene_row('LC08_L1TP_190027_20170216_20170301_01_T1', '2017-02-16 10:08:57.496393'),
+        ])
+        catalogue.build_catalogue(self.source, self.catalogue_dir)
+
+        self.assertEqual(self.scenes(190, 27), [
+            ('LC08_L1TP_190027_20150101_20170414_01_T1', pd.Timestamp('2015-01-01 10:00:00')),
+            ('LC08_L1TP_190027_20170216_20170301_01_T1', pd.Timestamp('2017-02-16 10:08:57.496393')),
+        ])
+
+
+    def test_refresh_is_the_same_as_a_rebuild(self):
+        rows = [
+            scene_row('LC08_L1TP_190027_20200101_20200113_01_T1', '2020-01-01 10:00:00.123456'),
+            scene_row('LC08_L1TP_191027_20200108_20200108_01_RT', '2020-01-08 10:00:00'),
+            scene_row('LC08_L1TP_190027_20200117_20200117_01_RT', '2020-01-17 10:00:00.5'),
+        ]
+        write_scene_list(self.source, rows)
+        catalogue.build_catalogue(self.source, self.catalogue_dir)
+
+        # the Real-Time scene of 2020-01-17 is processed again, and a new scene is acquired
+        rows += [
+            scene_row('LC08_L1TP_190027_20200117_20200127_01_T1', '2020-01-17 10:00:00.5'),
+            scene_row('LC08_L1TP_190027_20200202_20200202_01_RT', '2020-02-02 10:00:00'),
+        ]
+        write_scene_list(self.source, rows)
+        version_dir, new_rows = catalogue.refresh_catalogue(self.source, self.catalogue_dir)
+        self.assertEqual(new_rows, 2)
+
+        rebuilt_dir = catalogue.build_catalogue(self.source, os.path.join(self.directory, 'rebuilt'))
+        refreshed, rebuilt = catalogue.SceneCatalogue(version_dir), catalogue.SceneCatalogue(rebuilt_dir)
+        for name in catalogue.COLUMNS + ['flags']:
+            np.testing.assert_array_equal(refreshed.columns[name], rebuilt.columns[name])
+        self.assertEqual(refreshed.manifest['high_water_mark'], rebuilt.manifest['high_water_mark'])
+
+        self.assertEqual([product_id for product_id, _ in self.scenes(190, 27)], [
+            'LC08_L1TP_190027_20200101_20200113_01_T1',
+            'LC08_L1TP_190027_20200117_20200127_01_T1',
+            'LC08_L1TP_190027_20200202_20200202_01_RT',
+        ])
+        # nothing new
+        self.assertEqual(catalogue.refresh_catalogue(self.source, self.catalogue_dir), (version_dir, 0))
+
+    def test_refresh_of_a_rewritten_scene_list(self):
+        write_scene_list(self.source, [
+            scene_row('LC08_L1TP_190027_20200101_20200113_01_T1', '2020-01-01 10:00:00'),
+            scene_row('LC08_L1TP_190027_20200117_20200127_01_T1', '2020-01-17 10:00:00'),
+        ])
+        catalogue.build_catalogue(self.source, self.catalogue_dir)
+
+        write_scene_list(self.source, [
+            scene_row('LC08_L1TP_190027_20200117_20200127_01_T1', '2020-01-17 10:00:00'),
+            scene_row('LC08_L1TP_190027_20200202_20200212_01_T1', '2020-02-02 10:00:00'),
+        ])
+        with self.assertRaises(catalogue.CatalogueError):
+            catalogue.refresh_catalogue(self.source, self.catalogue_dir)
+
+
+# ----------------------------------------------- WRS-2 coverage of an area --------------------------------------------
+class CoverageTests(TestCase):
+    def wrs_index(self, tiles):
+        # index over synthetic tiles [(path, row, geometry)]
+        import geopandas as gpd
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        shapefile = os.path.join(directory, 'WRS2_descending.shp')
+        gpd.GeoDataFrame({'PATH': [path for path, _, _ in tiles], 'ROW': [row for _, row, _ in tiles],
+                          'MODE': 'D'}, geometry=[geometry for _, _, geometry in tiles], crs='EPSG:4326'
+                         ).to_file(shapefile)
+        return utils.WRSIndex(shapefile)
+
+    def uncovered_fraction(self, index, aoi, coverage):
+        tiles = [index.geometries[(index.paths == path) & (index.rows == row)][0] for path, row, _ in coverage]
+        return utils.equal_area(aoi.difference(shapely.union_all(tiles))) / utils.equal_area(aoi)
+
+    def test_sliver_is_covered(self):
+        index = self.wrs_index([(1, 1, shapely.box(0, 0, 10, 10)), (2, 1, shapely.box(10, 0, 20, 10))])
+        # 0.08% of the area of interest is in the second tile
+        aoi = shapely.box(0, 0, 10.008, 10)
+
+        coverage = index.coverage(aoi)
+        self.assertEqual([(path, row) for path, row, _ in coverage], [(1, 1), (2, 1)])
+        self.assertAlmostEqual(coverage[1][2], 0.0008, places=5)
+
+    def test_sliver_split_between_tiles_is_covered(self):
+        # the sliver is split between 4 tiles which each cover less than COVERAGE_TOLERANCE of the area of interest
+        tiles = [(1, 1, shapely.box(0, 0, 10, 10))]
+        tiles += [(2 + k, 1, shapely.box(10, 2.5 * k, 20, 2.5 * (k + 1))) for k in range(4)]
+        index = self.wrs_index(tiles)
+        aoi = shapely.box(0, 0, 10.003, 10)
+
+        coverage = index.coverage(aoi)
+        self.assertEqual(coverage[0][:2], (1, 1))
+        self.assertGreater(len(coverage), 1)
+        self.assertLessEqual(self.uncovered_fraction(index, aoi, coverage), utils.COVERAGE_TOLERANCE)
+
+    def test_all_intersecting_tiles(self):
+        index = self.wrs_index([(1, 1, shapely.box(0, 0, 10, 10)), (2, 1, shapely.box(5, 0, 15, 10)),
+                                (3, 1, shapely.box(30, 0, 40, 10))])
+        coverage = index.coverage(shapely.box(1, 1, 9, 9), minimal=False)
+
+        self.assertEqual([(path, row, round(fraction, 4)) for path, row, fraction in coverage],
+                         [(1, 1, 1.0), (2, 1, 0.5)])
+
+
+# --------------------------------------------------- Scene selection --------------------------------------------------
+def random_scenes(seed, size=12, path_rows=3):
+    # scenes of a few path/rows sorted by date, some of them acquired the same day or with the same cloud cover
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp('2020-01-01 10:00') + pd.to_timedelta(np.sort(rng.integers(0, 40, size)), unit='D')
+    return pd.DataFrame({
+        'Index': np.arange(size),
+        'productId': ['S{}'.format(k) for k in range(size)],
+        'acquisitionDate': dates + pd.to_timedelta(rng.integers(0, 60, size), unit='s'),
+        'cloudCover': rng.choice([-1.0, 5.0, 10.0, 35.5, 60.0, 80.0], size),
+        'index_for_path_and_row': rng.integers(0, path_rows, size),
+    })
+
+
+def loop_complementary_scenes(scenes, scene_product_id):
+    # the scenes of the other path/rows closest to the selected one by position, as selected before
+    # select_complementary_scenes
+    selected_scene = scenes.loc[scenes['productId'] == scene_product_id]
+    index_of_selected_scene = int(selected_scene['Index'].iloc[0])
+    distances = {idx: abs(idx - index_of_selected_scene) for idx in scenes['Index'].to_list()}
+    distances = dict(sorted(distances.items(), key=lambda item: item[1]))
+    del distances[index_of_selected_scene]
+
+    final_scenes = []
+    path_row_of_selected_scene = int(selected_scene['index_for_path_and_row'].iloc[0])
+    for idx in distances:
+        scene = scenes.loc[scenes['Index'] == idx]
+        if int(scene['index_for_path_and_row'].iloc[0]) != path_row_of_selected_scene:
+            final_scenes.append(scene)
+    final_scenes = pd.concat(final_scenes).drop_duplicates(subset='index_for_path_and_row', keep='first')
+    return pd.concat([final_scenes, selected_scene])
+
+
+class ComplementaryScenesTests(TestCase):
+    def test_same_as_the_loop(self):
+        for seed in range(5):
+            scenes = random_scenes(seed)
+            for product_id in scenes['productId']:
+                with self.subTest(seed=seed, productId=product_id):
+                    self.assertEqual(
+                        utils.select_complementary_scenes(scenes, product_id)['productId'].tolist(),
+                        loop_complementary_scenes(scenes, product_id)['productId'].tolist())
+
+    def test_closest_in_time(self):
+        for seed in range(5):
+            scenes = random_scenes(seed)
+            # scenes acquired the same day are at the same distance
+            scenes['acquisitionDate'] = scenes['acquisitionDate'].dt.floor('D')
+            dates = scenes['acquisitionDate'].tolist()
+            for k, product_id in enumerate(scenes['productId']):
+                # closest scene of every other path/row by time, then cloud cover, then position
+                group = scenes['index_for_path_and_row'][k]
+                closest = {}
+                for i in range(len(scenes)):
+                    other = scenes['index_for_path_and_row'][i]
+                    key = (abs(dates[i] - dates[k]), scenes['cloudCover'][i], i)
+                    if other != group and (other not in closest or key < closest[other]):
+                        closest[other] = key
+                expected = [scenes['productId'][i] for _, _, i in sorted(closest.values())] + [product_id]
+
+                with self.subTest(seed=seed, productId=product_id):
+                    selected = utils.select_complementary_scenes(scenes, product_id, by='time', tie_break='cloudCover')
+                    self.assertEqual(selected['productId'].tolist(), expected)
+
+
+class RankSceneSetsTests(TestCase):
+    def brute_force(self, scenes, max_cloud_cover=None, target_date=None):
+        # for every usable scene as first scene of a set, the set of one usable scene per path/row with the lowest score
+        # (over all the combinations), every set once with its best score, best first
+        days = (scenes['acquisitionDate'] - pd.Timestamp(0)).dt.total_seconds().to_numpy() / 86400
+        cloud = scenes['cloudCover'].to_numpy()
+        usable = [i for i in range(len(scenes))
+                  if cloud[i] >= 0 and (max_cloud_cover is None or cloud[i] <= max_cloud_cover)]
+        groups = scenes['index_for_path_and_row'].to_numpy()
+        by_group = [[i for i in usable if groups[i] == group] for group in np.unique(groups)]
+        if not all(by_group):
+            return []
+
+        best = {}
+        for anchor in usable:
+            candidates = [[anchor] if groups[anchor] == groups[members[0]] else members for members in by_group]
+            for combination in itertools.product(*candidates):
+                score = sum(cloud[i] + (abs(days[i] - days[anchor]) if i != anchor else 0) for i in combination)
+                if target_date is not None:
+                    score += abs(days[anchor] - (pd.Timestamp(target_date) - pd.Timestamp(0)).total_seconds() / 86400)
+                key = frozenset(scenes['productId'][i] for i in combination)
+                best_of_anchor = best.get(anchor)
+                if best_of_anchor is None or score < best_of_anchor[0]:
+                    best[anchor] = (score, key)
+
+        sets = {}
+        for score, key in best.values():
+            sets[key] = min(score, sets.get(key, np.inf))
+        return sorted((score, key) for key, score in sets.items())
+
+    def test_same_as_brute_force(self):
+        for seed in range(10):
+            scenes = random_scenes(seed, size=10)
+            # the scenes with the same date and cloud cover would make the best set of an anchor ambiguous
+            scenes['acquisitionDate'] += pd.to_timedelta(np.arange(len(scenes)) * 3600, unit='s')
+            scenes['cloudCover'] += np.where(scenes['cloudCover'] >= 0, np.arange(len(scenes)) * 0.01, 0)
+            for max_cloud_cover, target_date in [(None, None), (50, None), (None, '2020-01-20')]:
+                with self.subTest(seed=seed, max_cloud_cover=max_cloud_cover, target_date=target_date):
+                    scores, members = utils.rank_scene_sets(scenes, max_cloud_cover, target_date)
+                    ranked = [(score, frozenset(scenes['productId'].to_numpy()[row]))
+                              for score, row in zip(scores, members)]
+                    expected = self.brute_force(scenes, max_cloud_cover, target_date)
+
+                    self.assertEqual([key for _, key in ranked], [key for _, key in expected])
+                    np.testing.assert_allclose([score for score, _ in ranked], [score for score, _ in expected])
+
+    def test_every_set_is_ranked_once(self):
+        # B1 and B2 have the same date and cloud cover: {A, B1} is found from A and from B1, {A, B2} from B2
+        scenes = pd.DataFrame({
+            'productId': ['A', 'B1', 'B2', 'C'],
+            'acquisitionDate': pd.to_datetime(['2020-01-01', '2020-01-02', '2020-01-02', '2020-03-01']),
+            'cloudCover': [10.0, 20.0, 20.0, 90.0],
+            'index_for_path_and_row': [0, 1, 1, 0],
+        })
+        scores, members = utils.rank_scene_sets(scenes, max_cloud_cover=50)
+
+        sets = [frozenset(scenes['productId'].to_numpy()[row]) for row in members]
+        self.assertEqual(sets, [{'A', 'B1'}, {'A', 'B2'}])
+        self.assertEqual(list(scores), sorted(scores))
+
+    def test_no_complete_set(self):
+        scenes = pd.DataFrame({
+            'productId': ['A', 'B'],
+            'acquisitionDate': pd.to_datetime(['2020-01-01', '2020-01-02']),
+            'cloudCover': [10.0, 80.0],
+            'index_for_path_and_row': [0, 1],
+        })
+        scores, members = utils.rank_scene_sets(scenes, max_cloud_cover=50)
+
+        self.assertEqual((len(scores), members.shape), (0, (0, 2)))
+        self.assertEqual(len(utils.select_best_scenes(scenes, max_cloud_cover=50)), 0)
+
+
+# ------------------------------------------------ Earth Engine map layers ---------------------------------------------
+class FakeImage:
+    # stand-in for the images and collections of Earth Engine, every call returns the image itself
+    def __init__(self, ee, *args):
+        self.ee = ee
+
+    def __getattr__(self, name):
+        return lambda *args: self
+
+    def getMapId(self, vis_params):
+        self.ee.map_ids += 1
+        url = 'https://earthengine.googleapis.com/map/{}/{{z}}/{{x}}/{{y}}'.format(self.ee.map_ids)
+        return {'tile_fetcher': mock.Mock(url_format=url)}
+
+
+class FakeEE:
+    def __init__(self):
+        self.map_ids = 0
+
+    def Image(self, *args):
+        return FakeImage(self, *args)
+
+    ImageCollection = FeatureCollection = Image
+
+
+class EELayerTests(TestCase):
+    def setUp(self):
+        from . import ee_layers
+
+        self.ee_layers = ee_layers
+        self.ee = FakeEE()
+        ee_layers.set_ee(self.ee)
+        self.addCleanup(ee_layers.set_ee, None)
+        # the background refreshes are done with the fake module
+        self.addCleanup(lambda: ee_layers._refresh_pool.submit(lambda: None).result())
+        self.layer = ee_layers.EE_LAYERS[1]
+
+    def test_tile_url_is_cached(self):
+        url = self.ee_layers.get_tile_url(self.layer)
+
+        self.assertEqual(self.ee_layers.get_tile_url(self.layer), url)
+        self.assertEqual(self.ee.map_ids, 1)
+
+    def test_expired_tile_url_is_fetched_again(self):
+        url = self.ee_layers.get_tile_url(self.layer)
+        with override_settings(EE_TILE_URL_TTL=0):
+            self.assertNotEqual(self.ee_layers.get_tile_url(self.layer), url)
+        self.assertEqual(self.ee.map_ids, 2)
+
+    def test_tile_url_is_refreshed_in_the_background(self):
+        url = self.ee_layers.get_tile_url(self.layer)
+        with override_settings(EE_TILE_URL_TTL=60, EE_TILE_URL_REFRESH=0):
+            # the current url is returned while a new one is fetched
+            self.assertEqual(self.ee_layers.get_tile_url(self.layer), url)
+            self.ee_layers._refresh_pool.submit(lambda: None).result()
+            self.assertNotEqual(self.ee_layers.get_tile_url(self.layer), url)
+
+
+# -------------------------------------------------- Scene listing API -------------------------------------------------
+class SceneListTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+
+        dates = pd.date_range('2020-01-01 10:00', periods=40, freq='8D')
+        product_ids = ['LC08_L1TP_{}027_{:%Y%m%d}_20200201_01_T1'.format(path, date)
+                       for path in (190, 191) for date in dates]
+        frame = pd.DataFrame({
+            'productId': product_ids,
+            'entityId': ['LC8{:03d}'.format(k) for k in range(len(product_ids))],
+            'acquisitionDate': list(dates) * 2,
+            'cloudCover': [float(k % 17) for k in range(len(product_ids))],
+            'processingLevel': 'L1TP',
+            'path': [190] * len(dates) + [191] * len(dates),
+            'row': 27,
+            'min_lat': 47.0, 'min_lon': 14.0, 'max_lat': 49.0, 'max_lon': 17.0,
+            'download_url': ['https://landsat-pds.s3.amazonaws.com/{}/index.html'.format(p) for p in product_ids],
+        })
+        catalogue.write_catalogue(catalogue.frame_to_columns(frame), directory)
+
+        settings = override_settings(SCENE_CATALOGUE_DIR=directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def get(self, **query):
+        return self.client.get(reverse('scene_list'), query)
+
+    def test_page_of_scenes(self):
+        response = self.get(path_rows='190-27,191-27', fields='productId,cloudCover', sort='-cloudCover',
+                            page_size=10, page=2, starting_date='2020-02-01', ending_date='2020-06-01')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+
+        self.assertEqual((data['count'], data['page'], data['num_pages'], data['next']), (30, 2, 3, 3))
+        self.assertEqual([sorted(scene) for scene in data['results']], [['cloudCover', 'productId']] * 10)
+        cloud_cover = [scene['cloudCover'] for scene in data['results']]
+        self.assertEqual(cloud_cover, sorted(cloud_cover, reverse=True))
+
+    def test_invalid_queries(self):
+        for query in [{'path_rows': '190-x'},
+                      {'path_rows': '190-27', 'sort': 'productId'},
+                      {'path_rows': '190-27', 'fields': 'productId,password'},
+                      {'path_rows': '190-27', 'page_size': 'all'},
+                      {'path_rows': '190-27', 'starting_date': 'yesterday', 'ending_date': '2020-06-01'}]:
+            with self.subTest(**query):
+                response = self.get(**query)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+    def test_gzip(self):
+        response = self.client.get(reverse('scene_list'), {'path_rows': '190-27'}, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        data = json.loads(gzip.decompress(response.content))
+        self.assertEqual(data['count'], 40)
+        self.assertEqual(len(data['results']), 40)
+
+
+# ------------------------------------------------------ Geocoding -----------------------------------------------------
+class StubGeocoder:
+    # geocoder answering from a dict, counting the queries
+    def __init__(self, places):
+        self.places = places
+        self.queries = []
+
+    def geocode(self, query):
+        self.queries.append(query)
+        return self.places.get(query)
+
+
+class GeocodeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.geocoder = StubGeocoder({'vienna': geocoding.Place('Wien, Österreich', 48.2084, 16.3725)})
+        geocoding.set_geocoder(self.geocoder)
+        self.addCleanup(geocoding.set_geocoder, None)
+
+    def test_place_is_geocoded_once(self):
+        place = geocoding.geocode('Vienna')
+        self.assertEqual((str(place), place.latitude, place.longitude), ('Wien, Österreich', 48.2084, 16.3725))
+
+        # the same place name, from the cache
+        again = geocoding.geocode('  VIENNA ')
+        self.assertEqual((str(again), again.latitude, again.longitude), ('Wien, Österreich', 48.2084, 16.3725))
+        self.assertEqual(self.geocoder.queries, ['vienna'])
+
+    def test_place_from_the_database(self):
+        geocoding.geocode('Vienna')
+        cache.clear()
+
+        place = geocoding.geocode('vienna')
+        self.assertEqual(str(place), 'Wien, Österreich')
+        self.assertEqual(self.geocoder.queries, ['vienna'])
+        self.assertEqual(Geocode.objects.count(), 1)
+
+    def test_unknown_place_is_kept(self):
+        self.assertIsNone(geocoding.geocode('Atlantis'))
+        self.assertIsNone(geocoding.geocode('atlantis'))
+        self.assertEqual(self.geocoder.queries, ['atlantis'])
+        self.assertFalse(Geocode.objects.get(query='atlantis').found)
+
+    def test_empty_place_name(self):
+        self.assertIsNone(geocoding.geocode('  '))
+        self.assertEqual(self.geocoder.queries, [])
+
+
+# ------------------------------------------------- Indicator registry -------------------------------------------------
+def per_indicator_branch(indicator, band4, band5, band6, band7):
+    # the indicators as computed by the per-indicator branches of compute_indicator before the registry
+    red, nir, swir, swir2 = (np.array(band, dtype='int32') for band in (band4, band5, band6, band7))
+    if indicator == 'NDVI':
+        numerator, denominator, background = np.subtract(nir, red), np.add(red, nir), red
+    elif indicator == 'NDWI':
+        numerator, denominator, background = np.subtract(nir, swir), np.add(swir, nir), swir
+    elif indicator == 'NDSI':
+        numerator, denominator, background = np.subtract(swir, nir), np.add(swir, nir), nir
+    elif indicator == 'SLAVI':
+        numerator, denominator, background = nir, np.add(swir, red), red
+    elif indicator == 'NDRE':
+        numerator, denominator, background = np.subtract(nir, swir2), np.add(swir2, nir), nir
+
+    result = np.zeros(red.shape)
+    np.true_divide(numerator, denominator, out=result, where=denominator != 0)
+    result[result < 0] = 0
+    result[np.where(abs(background) == 0)] = np.nan
+    return result.astype('float32')
+
+
+class IndicatorRegistryTests(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.bands = {band: rng.integers(low, high, (64, 80)).astype('uint16')
+                      for band, low, high in [('B2', 5000, 12000), ('B4', 6000, 15000), ('B5', 8000, 30000),
+                                              ('B6', 6000, 25000), ('B7', 5000, 20000)]}
+        for band in self.bands.values():
+            band[rng.random(band.shape) < 0.05] = 0
+
+    def evaluate(self, indicator):
+        blocks = {band: self.bands[band].astype('float32') for band in utils.required_bands(indicator)}
+        shape = self.bands['B4'].shape
+        return utils.evaluate_indicator(utils.get_indicator(indicator), blocks, np.empty(shape, dtype='float32'),
+                                        np.empty(shape, dtype='float32'), np.empty(shape, dtype='float32'))
+
+    def test_same_as_per_indicator_branches(self):
+        for indicator in ['NDVI', 'NDWI', 'NDSI', 'SLAVI', 'NDRE']:
+            with self.subTest(indicator=indicator):
+                expected = per_indicator_branch(indicator, *(self.bands[band] for band in ['B4', 'B5', 'B6', 'B7']))
+                np.testing.assert_array_equal(self.evaluate(indicator), expected)
+
+    def test_evi_on_reflectances(self):
+        blue, red, nir = ((2e-5 * self.bands[band] - 0.1) for band in ['B2', 'B4', 'B5'])
+        expected = 2.5 * (nir - red) / (nir + 6 * red - 7.5 * blue + 1)
+        expected[expected < 0] = 0
+        expected[self.bands['B4'] == 0] = np.nan
+
+        self.assertEqual(utils.required_bands('EVI'), ['B2', 'B4', 'B5'])
+        np.testing.assert_allclose(self.evaluate('EVI'), expected, rtol=1e-5)
+
+
+# ---------------------------------------------- GeoTIFF output profiles -----------------------------------------------
+class OutputProfileTests(TestCase):
+    def setUp(self):
+        import rasterio
+        from rasterio.transform import from_origin
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'NDVI.TIF')
+        meta = utils.output_meta({'width': 700, 'height': 600, 'count': 1, 'dtype': 'float32', 'crs': 'EPSG:32633',
+                                  'transform': from_origin(500000, 5300000, 30, 30)}, 'cog')
+        with rasterio.open(self.path, 'w', **meta) as dst:
+            dst.write(np.random.default_rng(0).random((600, 700), dtype='float32'), 1)
+
+    def deflate_level(self):
+        # compression level (0 fastest, 1 fast, 2 default, 3 best) in the zlib header of the first block
+        import rasterio
+
+        with rasterio.open(self.path) as src:
+            offset = int(src.get_tag_item('BLOCK_OFFSET_0_0', 'TIFF', bidx=1))
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(2)[1] >> 6
+
+    def test_cog_compression_level(self):
+        import rasterio
+
+        for zlevel, level in [(1, 0), (9, 3)]:
+            profile = dict(utils.OUTPUT_PROFILES['cog'], options={'zlevel': zlevel})
+            with mock.patch.dict(utils.OUTPUT_PROFILES, cog=profile), self.assertNoLogs('rasterio', 'WARNING'):
+                utils.finish_output(self.path, 'cog')
+
+            with rasterio.open(self.path) as src:
+                structure = src.tags(ns='IMAGE_STRUCTURE')
+            self.assertEqual((structure['LAYOUT'], structure['COMPRESSION'], structure['PREDICTOR']),
+                             ('COG', 'DEFLATE', '3'))
+            self.assertEqual(self.deflate_level(), level)
+
+
+# ------------------------------------------------------ XYZ tiles -----------------------------------------------------
+def decode_png(png):
+    # RGBA pixels of a PNG written by mosaic.encode_png (one IDAT chunk, no filter)
+    width, height = struct.unpack('>II', png[16:24])
+    start = png.index(b'IDAT') + 4
+    size = struct.unpack('>I', png[start - 8:start - 4])[0]
+    raw = np.frombuffer(zlib.decompress(png[start:start + size]), dtype='uint8').reshape(height, -1)
+    return raw[:, 1:].reshape(height, width, 4)
+
+
+class TileCacheTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        # room for 3 tiles, the budget is checked for every new tile
+        self.cache = TileCache(directory, 3 * 100)
+        self.cache.EVICT_INTERVAL = 1
+
+    def set_tile(self, y, used):
+        # a tile of 100 bytes, last used <used> seconds ago
+        tile_path = self.cache.set_tile('key', 10, 550, y, bytes(100))
+        os.utime(tile_path, (time.time() - used, time.time() - used))
+
+    def test_least_recently_used_tile_is_removed(self):
+        for y, used in [(1, 30), (2, 20), (3, 10)]:
+            self.set_tile(y, used)
+        # the oldest tile is used again
+        self.assertEqual(self.cache.get_tile('key', 10, 550, 1), bytes(100))
+
+        self.set_tile(4, 0)
+        self.assertIsNone(self.cache.get_tile('key', 10, 550, 2))
+        for y in [1, 3, 4]:
+            self.assertIsNotNone(self.cache.get_tile('key', 10, 550, y))
+
+
+class TileTests(TestCase):
+    def setUp(self):
+        import rasterio
+        from rasterio.transform import from_bounds
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.cache = TileCache(os.path.join(directory, 'tiles'), 1024 ** 2)
+        patcher = mock.patch.object(tiles, 'get_tile_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # raster exactly on the tile 10/550/360, the right half without data
+        self.result_dir = os.path.join(directory, 'result')
+        os.makedirs(self.result_dir)
+        data = np.tile(np.linspace(0, 1, 256, dtype='float32'), (256, 1))
+        data[:, 128:] = np.nan
+        with rasterio.open(os.path.join(self.result_dir, 'OUTPUT1.tiff'), 'w', driver='GTiff', width=256, height=256,
+                           count=1, dtype='float32', crs=tiles.WEB_MERCATOR, nodata=np.nan,
+                           transform=from_bounds(*tiles.tile_bounds(10, 550, 360), 256, 256)) as dst:
+            dst.write(data, 1)
+
+    def test_tile_is_rendered_once(self):
+        with mock.patch.object(tiles, 'render_tile', wraps=tiles.render_tile) as render_tile:
+            png = tiles.get_tile('key', self.result_dir, 10, 550, 360)
+            self.assertEqual(tiles.get_tile('key', self.result_dir, 10, 550, 360), png)
+        self.assertEqual(render_tile.call_count, 1)
+
+        alpha = decode_png(png)[:, :, 3]
+        self.assertTrue((alpha[:, :128] == 255).all())
+        self.assertTrue((alpha[:, 128:] == 0).all())
+
+    def test_tile_outside_of_the_rasters_is_transparent(self):
+        png = tiles.get_tile('key', self.result_dir, 10, 552, 360)
+        self.assertTrue((decode_png(png)[:, :, 3] == 0).all())
+
+    def test_tile_view(self):
+        job = Job.objects.create(location='Austria', indicator='NDVI', scenes='[]', state=Job.DONE, result='key')
+        result_cache = mock.Mock(get_result=lambda key: self.result_dir if key == 'key' else None)
+        with mock.patch('satellite_data_processing.views.get_result_cache', return_value=result_cache):
+            response = self.client.get(reverse('tile', args=[job.id, 10, 550, 360]))
+            self.assertEqual((response.status_code, response['Content-Type']), (200, 'image/png'))
+            self.assertEqual(response.content, self.cache.get_tile('key', 10, 550, 360))
+
+            self.assertEqual(self.client.get(reverse('tile', args=[job.id, 10, 2 ** 10, 360])).status_code, 404)
+
+
+# ----------------------------------------- Masking data (bands) with shapefile ----------------------------------------
+class MaskGeometryTests(TestCase):
+    def test_simplification_only_changes_border_pixels(self):
+        import geopandas as gpd
+        import rasterio.features
+        from rasterio.transform import from_origin
+
+        # a country with a jagged border (one vertex every few meters)
+        angles = np.linspace(0, 2 * np.pi, 20000, endpoint=False)
+        radius = 20000 + 300 * np.sin(angles * 40) + np.random.default_rng(0).normal(0, 10, angles.size)
+        country = shapely.Polygon(np.column_stack([540000 + radius * np.cos(angles),
+                                                   5270000 + radius * np.sin(angles)]))
+        countries = gpd.GeoDataFrame({'ADMIN': ['Testland']}, geometry=[country], crs='EPSG:32633')
+
+        utils.get_mask_geometry.cache_clear()
+        self.addCleanup(utils.get_mask_geometry.cache_clear)
+        with mock.patch.object(utils, 'get_countries', return_value=countries):
+            simplified = utils.get_mask_geometry('Testland', countries.crs.to_wkt(), 30.0)
+
+        transform = from_origin(515000, 5295000, 30, 30)
+        masks = [rasterio.features.geometry_mask([geometry], out_shape=(1700, 1700), transform=transform)
+                 for geometry in [country, simplified]]
+        rows, cols = np.nonzero(masks[0] != masks[1])
+        self.assertLess(rows.size, 0.01 * np.count_nonzero(~masks[0]))
+
+        centres = shapely.points(*(transform * (cols + 0.5, rows + 0.5)))
+        self.assertLessEqual(shapely.distance(country.boundary, centres).max(), 15.0 + 1e-6)
+
+
+# -------------------------------------------------- Zonal statistics --------------------------------------------------
+class ZonalStatisticsTests(TestCase):
+    def setUp(self):
+        import rasterio
+        from rasterio.transform import from_origin
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.mask_cache = MaskCache(os.path.join(self.directory, 'masks'), 1 << 30)
+        for target, value in [('get_mask_cache', lambda: self.mask_cache), ('BLOCK_ROWS', 128),
+                              ('MASK_BLOCK_ROWS', 100)]:
+            patcher = mock.patch.object(utils, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # 2 bands of 700 x 301 pixels, the location is a triangle inside the bands
+        self.transform = from_origin(500000, 5300000, 30, 30)
+        self.geometry = shapely.Polygon([(503000, 5298000), (508500, 5290000), (501000, 5281000)])
+        rng = np.random.default_rng(0)
+        self.band_paths = {}
+        for band in ['B4', 'B5']:
+            data = rng.integers(1, 30000, (700, 301), dtype='uint16')
+            data[:50] = 0
+            self.band_paths[band] = os.path.join(self.directory, band + '.TIF')
+            with rasterio.open(self.band_paths[band], 'w', driver='GTiff', width=301, height=700, count=1,
+                               dtype='uint16', crs='EPSG:32633', transform=self.transform, nodata=0) as dst:
+                dst.write(data, 1)
+
+    def expected_values(self):
+        # values of the indicator inside the location, from the full bands
+        import rasterio
+        import rasterio.features
+
+        bands = {}
+        for band, path in self.band_paths.items():
+            with rasterio.open(path) as src:
+                bands[band] = src.read(1).astype('float32')
+                window = rasterio.features.geometry_window(src, [self.geometry])
+                window_transform = src.window_transform(window)
+        out = utils.evaluate_indicator(utils.get_indicator('NDVI'), bands, np.empty((700, 301), dtype='float32'),
+                                       np.empty((700, 301), dtype='float32'))
+
+        inside = np.zeros((700, 301), dtype=bool)
+        inside[window.toslices()] = ~rasterio.features.geometry_mask(
+            [self.geometry], out_shape=(window.height, window.width), transform=window_transform)
+        return out[inside & ~np.isnan(out)], np.count_nonzero(inside)
+
+    def test_statistics_by_block(self):
+        values, pixels = self.expected_values()
+        with mock.patch.object(utils, 'get_mask_geometry', return_value=self.geometry):
+            statistics = zonal.band_statistics(self.band_paths, 'NDVI', 'Testland', '190027').as_dict()
+            again = zonal.band_statistics(self.band_paths, 'NDVI', 'Testland', '190027').as_dict()
+
+        self.assertEqual((statistics['pixels'], statistics['valid_pixels']), (pixels, values.size))
+        self.assertAlmostEqual(statistics['mean'], float(values.mean()), places=6)
+        self.assertAlmostEqual(statistics['min'], float(values.min()), places=6)
+        self.assertAlmostEqual(statistics['max'], float(values.max()), places=6)
+        self.assertEqual(again, statistics)
+        # one mask (the window of the location) is rasterized and cached
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'masks', '190027'))), 1)
+
+    def test_location_outside_of_the_bands(self):
+        with mock.patch.object(utils, 'get_mask_geometry', return_value=shapely.box(600000, 5000000, 610000, 5010000)):
+            statistics = zonal.band_statistics(self.band_paths, 'NDVI', 'Testland', '190027').as_dict()
+        self.assertEqual((statistics['pixels'], statistics['mean']), (0, None))
+
+
+# ------------------------------------------------------ Disk caches ---------------------------------------------------
+class DiskCacheTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write(self, file_path, age=0):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(bytes(100))
+        os.utime(file_path, (time.time() - age, time.time() - age))
+        return file_path
+
+    def test_stale_temporary_files_are_removed(self):
+        cache = BandCache(self.directory, 1000)
+        # partial files of a worker stopped two hours ago, and of a download in progress
+        stale = [self.write(cache.band_path('LC08_A', filename), age=2 * 60 * 60)
+                 for filename in ['LC08_A_B4.TIF.1234.part', 'LC08_A_B5.TIF.{}.tmp'.format(uuid.uuid4().hex)]]
+        partial = self.write(cache.band_path('LC08_A', 'LC08_A_B6.TIF.5678.part'))
+
+        band_path = cache.band_path('LC08_A', 'LC08_A_B4.TIF')
+        cache.publish(self.write(cache.tmp_path(band_path)), band_path)
+
+        self.assertEqual([os.path.exists(file_path) for file_path in stale + [partial, band_path]],
+                         [False, False, True, True])
+
+    def test_stale_temporary_results_are_removed(self):
+        cache = ResultCache(self.directory, 1000)
+        stale = cache.tmp_dir('stale')
+        self.write(os.path.join(stale, 'OUTPUT1.tiff'), age=2 * 60 * 60)
+        os.utime(stale, (time.time() - 2 * 60 * 60, time.time() - 2 * 60 * 60))
+        running = cache.tmp_dir('running')
+
+        tmp_dir = cache.tmp_dir('key')
+        self.write(os.path.join(tmp_dir, 'OUTPUT1.tiff'))
+        result_dir = cache.publish_result(tmp_dir, 'key')
+
+        self.assertEqual([os.path.exists(path) for path in [stale, running, result_dir]], [False, True, True])
+
+
+# -------------------------------------------------- Band downloads ----------------------------------------------------
+BAND = bytes(range(256)) * 4096
+
+
+class BandHandler(http.server.BaseHTTPRequestHandler):
+    # S3 stand-in serving BAND with Range requests and the md5 as ETag; with cut, the first response is cut in the
+    # middle
+    requests = []
+    cut = True
+
+    def do_GET(self):
+        BandHandler.requests.append(self.headers.get('Range'))
+        start = int(self.headers['Range'][len('bytes='):-1]) if self.headers.get('Range') else 0
+        body = BAND[start:]
+
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"{}"'.format(hashlib.md5(BAND).hexdigest()))
+        if start:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(BAND) - 1, len(BAND)))
+        self.end_headers()
+
+        if BandHandler.cut and len(BandHandler.requests) == 1:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        # sent in parts, so concurrent downloads overlap
+        for start in range(0, len(body), 64 * 1024):
+            self.wfile.write(body[start:start + 64 * 1024])
+            time.sleep(0.005)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTests(TestCase):
+    def setUp(self):
+        BandHandler.requests = []
+        BandHandler.cut = True
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), BandHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.url = 'http://127.0.0.1:{}/LC08_B4.TIF'.format(self.server.server_port)
+
+    def test_interrupted_download_is_resumed(self):
+        file_path = os.path.join(self.directory, 'LC08_B4.TIF')
+        with mock.patch.object(utils, 'DOWNLOAD_BACKOFF', 0), mock.patch.object(utils, 'DOWNLOAD_CHUNK_SIZE', 1024), \
+                requests.Session() as session:
+            utils.download_file(self.url, file_path, session)
+
+        with open(file_path, 'rb') as f:
+            self.assertEqual(f.read(), BAND)
+        # the second request only asks for the missing bytes
+        self.assertEqual(BandHandler.requests, [None, 'bytes={}-'.format(len(BAND) // 2)])
+        self.assertEqual(os.listdir(self.directory), ['LC08_B4.TIF'])
+
+    def test_concurrent_downloads_of_the_same_band(self):
+        # every download writes its own partial file, the band is complete whichever finishes last
+        BandHandler.cut = False
+        file_path = os.path.join(self.directory, 'LC08_B4.TIF')
+        with mock.patch.object(utils, 'DOWNLOAD_CHUNK_SIZE', 1024), requests.Session() as session, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            downloads = [pool.submit(utils.download_file, self.url, file_path, session) for _ in range(4)]
+            for download in downloads:
+                download.result()
+
+        with open(file_path, 'rb') as f:
+            self.assertEqual(f.read(), BAND)
+        # no download was disturbed by another one (and retried)
+        self.assertEqual(len(BandHandler.requests), 4)
+        self.assertEqual(os.listdir(self.directory), ['LC08_B4.TIF'])
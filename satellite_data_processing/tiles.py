@@ -0,0 +1,130 @@
+import functools
+import glob
+import math
+import os
+
+import numpy as np
+import rasterio
+import rasterio.warp
+import rasterio.windows
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.transform import Affine, from_bounds
+
+from .disk_cache import get_tile_cache
+from .mosaic import colourize, encode_png, read_decimated
+
+# ------------------------------------------------------ XYZ tiles -----------------------------------------------------
+# Web mercator tiles (z/x/y, as used by leaflet/folium) of the indicator rasters of a result, rendered on demand: for
+# every tile only the window of the rasters under the tile is read, at the resolution of the tile (from the overviews
+# of the rasters when the tile is zoomed out). The rendered tiles are kept in a disk cache shared by the workers, the
+# least recently used tiles are removed first (see disk_cache.TileCache). All the tiles of a result use the same colour
+# scale.
+
+TILE_SIZE = 256
+WEB_MERCATOR = 'EPSG:3857'
+MAX_ZOOM = 20
+
+# half of the width of the web mercator world in meters
+ORIGIN_SHIFT = 20037508.342789244
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z, x, y):
+    # (left, bottom, right, top) of the tile in web mercator
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    left = -ORIGIN_SHIFT + x * size
+    top = ORIGIN_SHIFT - y * size
+    return left, top - size, left + size, top
+
+
+def result_rasters(result_dir):
+    return sorted(glob.glob(os.path.join(result_dir, 'OUTPUT*.tiff')))
+
+
+@functools.lru_cache(maxsize=128)
+def result_range(result_dir):
+    # (min, max) of the values of the rasters of a result (the results do not change), from a coarse read
+    values = []
+    for image_path in result_rasters(result_dir):
+        with rasterio.open(image_path) as src:
+            data, _ = read_decimated(src, abs(src.res[0]) * max(1.0, max(src.width, src.height) / 512))
+        data = data[~np.isnan(data)]
+        if data.size:
+            values.extend([data.min(), data.max()])
+    if not values:
+        return 0.0, 1.0
+    return float(min(values)), float(max(values))
+
+
+def source_window(src, bounds):
+    # window of the raster covering the bounds (in the CRS of the raster), whole pixels, None if they do not overlap
+    window = rasterio.windows.from_bounds(*bounds, transform=src.transform)
+    row_start, col_start = math.floor(window.row_off), math.floor(window.col_off)
+    row_stop = math.ceil(window.row_off + window.height)
+    col_stop = math.ceil(window.col_off + window.width)
+    window = rasterio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    try:
+        return window.intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+    except WindowError:
+        return None
+
+
+def render_tile(image_paths, z, x, y, vmin, vmax):
+    # PNG of the tile z/x/y of the rasters (transparent where there is no data)
+    bounds = tile_bounds(z, x, y)
+    dst_transform = from_bounds(*bounds, TILE_SIZE, TILE_SIZE)
+    tile = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype='float32')
+
+    for image_path in image_paths:
+        with rasterio.open(image_path) as src:
+            src_bounds = rasterio.warp.transform_bounds(WEB_MERCATOR, src.crs, *bounds)
+            window = source_window(src, src_bounds)
+            if window is None or window.width == 0 or window.height == 0:
+                continue
+
+            # the window is read at the resolution of the tile (GDAL uses the overviews of the raster)
+            pixel_size = (src_bounds[2] - src_bounds[0]) / TILE_SIZE
+            factor = max(1.0, pixel_size / abs(src.res[0]))
+            out_shape = (max(1, math.ceil(window.height / factor)), max(1, math.ceil(window.width / factor)))
+            data = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.nearest)
+            data = data.astype('float32', copy=False)
+            if src.nodata is not None and not np.isnan(src.nodata):
+                data[data == src.nodata] = np.nan
+            src_transform = src.window_transform(window) * Affine.scale(window.width / out_shape[1],
+                                                                        window.height / out_shape[0])
+
+            part = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype='float32')
+            rasterio.warp.reproject(data, part,
+                                    src_crs=src.crs, src_transform=src_transform, src_nodata=np.nan,
+                                    dst_crs=WEB_MERCATOR, dst_transform=dst_transform, dst_nodata=np.nan,
+                                    resampling=Resampling.nearest)
+            np.copyto(tile, part, where=~np.isnan(part))
+
+    return encode_png(colourize(tile, vmin, vmax))
+
+
+def get_tile(key, result_dir, z, x, y):
+    # PNG of a tile of a result, from the tile cache or rendered
+    cache = get_tile_cache()
+    png = cache.get_tile(key, z, x, y)
+    if png is None:
+        vmin, vmax = result_range(result_dir)
+        png = render_tile(result_rasters(result_dir), z, x, y, vmin, vmax)
+        cache.set_tile(key, z, x, y, png)
+    return png
+
+
+def result_bounds(result_dir):
+    # [[south, west], [north, east]] of the rasters of a result in degrees (to fit a map on the result)
+    bounds = []
+    for image_path in result_rasters(result_dir):
+        with rasterio.open(image_path) as src:
+            bounds.append(rasterio.warp.transform_bounds(src.crs, 'EPSG:4326', *src.bounds))
+    if not bounds:
+        return None
+    return [[min(b[1] for b in bounds), min(b[0] for b in bounds)],
+            [max(b[3] for b in bounds), max(b[2] for b in bounds)]]
@@ -5,5 +5,10 @@ urlpatterns = [
     path('', views.aws, name='aws'),
     path('about/', views.about, name='about'),
     path('google_earth_engine/', views.google_earth_engine, name='google_earth_engine'),
-    path('aws_img/', views.aws_img, name='aws_img'),
+    path('api/scenes/', views.scene_list, name='scene_list'),
+    path('aws_img/<uuid:job_id>/', views.aws_img, name='aws_img'),
+    path('jobs/<uuid:job_id>/', views.job_status, name='job_status'),
+    path('results/<slug:key>.png', views.result_image, name='result_image'),
+    path('results/<slug:key>.<str:format>', views.result_statistics, name='result_statistics'),
+    path('tiles/<uuid:job_id>/<int:z>/<int:x>/<int:y>.png', views.tile, name='tile'),
 ]
@@ -1,5 +1,28 @@
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.geometry
+from django.conf import settings
 from django.contrib.gis.geoip2 import GeoIP2
 
+from .disk_cache import get_band_cache, get_mask_cache
+
 # Helper Functions
 
 
@@ -13,464 +36,1001 @@ def get_ip_address(request):
     return ip
 
 
-# get the location of an ip
-def get_geoip(ip):
-    g = GeoIP2()
-    country = g.country(ip)
-    city = g.city(ip)
-    lat, lon = g.lat_lon(ip)
+_geoip = None
+_geoip_lock = threading.Lock()
 
-    return country, city, lat, lon
 
+def get_geoip_reader():
+    # the GeoIP databases are opened once per process
+    global _geoip
+    if _geoip is None:
+        with _geoip_lock:
+            if _geoip is None:
+                _geoip = GeoIP2()
+    return _geoip
 
-# ------------------------------------------------- Google Earth Engine ------------------------------------------------
-# code from https://github.com/giswqs/qgis-earthengine-examples/blob/master/Folium/ee-api-folium-setup.ipynb
-import ee
-import folium
 
-# ee.Authenticate()
-ee.Initialize()
+# get the location of an ip (one lookup in the city database, which contains the country and the coordinates as well)
+def get_geoip(ip):
+    city = get_geoip_reader().city(ip)
+    country = {'country_code': city['country_code'], 'country_name': city['country_name']}
+    lat, lon = city['latitude'], city['longitude']
 
+    return country, city, lat, lon
 
-# Define a method for displaying Earth Engine image tiles on a folium map.
-def add_ee_layer(self, ee_object, vis_params, name):
-    try:
-        # display ee.Image()
-        if isinstance(ee_object, ee.image.Image):
-            map_id_dict = ee.Image(ee_object).getMapId(vis_params)
-            folium.raster_layers.TileLayer(
-                tiles=map_id_dict['tile_fetcher'].url_format,
-                attr='Google Earth Engine',
-                name=name,
-                overlay=True,
-                control=True,
-                show=False,
-            ).add_to(self)
-        # display ee.ImageCollection()
-        elif isinstance(ee_object, ee.imagecollection.ImageCollection):
-            ee_object_new = ee_object.mosaic()
-            map_id_dict = ee.Image(ee_object_new).getMapId(vis_params)
-            folium.raster_layers.TileLayer(
-                tiles=map_id_dict['tile_fetcher'].url_format,
-                attr='Google Earth Engine',
-                name=name,
-                overlay=True,
-                control=True,
-                show=False,
-            ).add_to(self)
-        # display ee.Geometry()
-        elif isinstance(ee_object, ee.geometry.Geometry):
-            folium.GeoJson(
-                data=ee_object.getInfo(),
-                name=name,
-                overlay=True,
-                control=True,
-                show=False,
-            ).add_to(self)
-        # display ee.FeatureCollection()
-        elif isinstance(ee_object, ee.featurecollection.FeatureCollection):
-            ee_object_new = ee.Image().paint(ee_object, 0, 2)
-            map_id_dict = ee.Image(ee_object_new).getMapId(vis_params)
-            folium.raster_layers.TileLayer(
-                tiles=map_id_dict['tile_fetcher'].url_format,
-                attr='Google Earth Engine',
-                name=name,
-                overlay=True,
-                control=True,
-                show=False,
-            ).add_to(self)
-
-    except:
-        print("Could not display {}".format(name))
-
-
-# Add EE drawing method to folium.
-folium.Map.add_ee_layer = add_ee_layer
 
 # ----------------------------------- Convert Latitude and Longitude to Row and Path -----------------------------------
 # https://www.earthdatascience.org/tutorials/convert-landsat-path-row-to-lat-lon/
 
-import io
-from osgeo import ogr
-import osgeo
-import shapely.wkt
-import shapely.geometry
-import urllib.request
-import zipfile
+WRS_URL = "https://prd-wret.s3-us-west-2.amazonaws.com/assets/palladium/production/s3fs-public/atoms/files/WRS2_descending_0.zip"
+WRS_DIR = 'landsat-path-row'
+WRS_SHAPEFILE = os.path.join(WRS_DIR, 'WRS2_descending.shp')
 
-url = "https://prd-wret.s3-us-west-2.amazonaws.com/assets/palladium/production/s3fs-public/atoms/files/WRS2_descending_0.zip"
-r = urllib.request.urlopen(url)
-zip_file = zipfile.ZipFile(io.BytesIO(r.read()))
-zip_file.extractall("landsat-path-row")
-zip_file.close()
+# files of the shapefile which have to be in the directory
+WRS_FILES = ['WRS2_descending.shp', 'WRS2_descending.shx', 'WRS2_descending.dbf', 'WRS2_descending.prj']
 
 
-def get_path_row(lat, lon):
-    shapefile = 'landsat-path-row/WRS2_descending.shp'
-    wrs = osgeo.ogr.Open(shapefile)
-    layer = wrs.GetLayer(0)
-
-    point = shapely.geometry.Point(lon, lat)
-    mode = 'D'
-
-    def checkPoint(feature, point, mode):
-        geom = feature.GetGeometryRef()  # Get geometry from feature
-        shape = shapely.wkt.loads(geom.ExportToWkt())  # Import geometry into shapely to easily work with the point
-        if point.within(shape) and feature['MODE'] == mode:
-            return True
-        else:
-            return False
+def wrs_shapefile_complete(directory=WRS_DIR):
+    return all(os.path.isfile(os.path.join(directory, f)) and os.path.getsize(os.path.join(directory, f)) > 0
+               for f in WRS_FILES)
+
+
+def download_wrs_shapefile(directory=WRS_DIR, url=WRS_URL):
+    # The WRS-2 shapefile is downloaded only when it is not on disk yet (instead of every time the module is imported).
+    # The zip file is checked (CRC of every file) and extracted into a temporary directory; the files are then moved
+    # into the directory, the .shp file last, so the shapefile is only complete once all its files are there.
+    shapefile = os.path.join(directory, os.path.basename(WRS_SHAPEFILE))
+    if wrs_shapefile_complete(directory):
+        return shapefile
+
+    print("---- Downloading the WRS-2 shapefile")
+    with urllib.request.urlopen(url) as response:
+        data = response.read()
+
+    tmp_dir = '{}.{}.tmp'.format(os.path.normpath(directory), uuid.uuid4().hex)
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            corrupt = zip_file.testzip()
+            if corrupt is not None:
+                raise IOError("Corrupt file in {}: {}".format(url, corrupt))
+            zip_file.extractall(tmp_dir)
+        if not wrs_shapefile_complete(tmp_dir):
+            raise IOError("Incomplete WRS-2 shapefile in {}".format(url))
+
+        os.makedirs(directory, exist_ok=True)
+        filenames = sorted(os.listdir(tmp_dir), key=lambda f: f == os.path.basename(shapefile))
+        for filename in filenames:
+            os.replace(os.path.join(tmp_dir, filename), os.path.join(directory, filename))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return shapefile
+
+
+# simplification of the areas of interest (degrees, about 1 km; the tiles are 185 km wide)
+AOI_TOLERANCE = 0.01
+
+# fraction of an area of interest which may stay uncovered by the minimal set of tiles
+COVERAGE_TOLERANCE = 1e-4
+
+
+def equal_area(geometry):
+    # area of a lon/lat geometry in the sinusoidal projection (equal-area), in square degrees at the equator
+    return shapely.area(shapely.transform(geometry, lambda xy: np.column_stack(
+        [xy[:, 0] * np.cos(np.radians(xy[:, 1])), xy[:, 1]])))
+
+
+class WRSIndex:
+    """Spatial index (STRtree) over the WRS-2 tiles of one mode, built once from the shapefile."""
+
+    def __init__(self, shapefile=WRS_SHAPEFILE, mode='D'):
+        import geopandas as gpd
+
+        tiles = gpd.read_file(shapefile)
+        tiles = tiles.loc[tiles['MODE'] == mode]
+
+        # keep the order of the features in the shapefile, the results are returned in that order
+        self.geometries = np.asarray(tiles.geometry.values, dtype=object)
+        self.paths = tiles['PATH'].to_numpy()
+        self.rows = tiles['ROW'].to_numpy()
+
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def _path_rows(self, tile_indices):
+        return [(int(self.paths[i]), int(self.rows[i])) for i in np.sort(tile_indices)]
+
+    def path_rows(self, lat, lon):
+        # all the tiles the point lies within (same test as point.within(shape) on every feature)
+        point = shapely.geometry.Point(lon, lat)
+        return self._path_rows(self.tree.query(point, predicate='within'))
+
+    def path_rows_many(self, points):
+        # points is a list of (lat, lon), one list of (path, row) is returned per point
+        points = shapely.points([(lon, lat) for lat, lon in points])
+        point_indices, tile_indices = self.tree.query(points, predicate='within')
+
+        return [self._path_rows(tile_indices[point_indices == i]) for i in range(len(points))]
+
+    def coverage(self, aoi, minimal=True, tolerance=AOI_TOLERANCE):
+        # Path/rows of the tiles covering an area of interest (shapely polygon in lon/lat, e.g. a country or a drawn
+        # polygon), with the fraction of the area of interest covered by every tile: [(path, row, fraction), ...].
+        # The area of interest is simplified to tolerance (degrees), the candidate tiles are found with the bounding
+        # boxes of the tree and tested with the prepared tiles. With minimal, only the tiles needed to cover the area
+        # of interest are returned (greedy set cover: the tile covering the largest uncovered area first), otherwise
+        # all the intersecting tiles, ordered by fraction.
+        aoi = shapely.make_valid(aoi).simplify(tolerance, preserve_topology=True)
+        candidates = np.sort(self.tree.query(aoi, predicate='intersects'))
+        if len(candidates) == 0 or aoi.is_empty:
+            return []
+
+        # parts of the area of interest in every tile, areas in an equal-area (sinusoidal) projection
+        pieces = shapely.intersection(self.geometries[candidates], aoi)
+        total = equal_area(aoi)
+        fractions = np.array([equal_area(piece) for piece in pieces]) / total
+
+        if not minimal:
+            order = np.argsort(-fractions, kind='stable')
+            return [(int(self.paths[candidates[i]]), int(self.rows[candidates[i]]), float(fractions[i]))
+                    for i in order if fractions[i] > 0]
+
+        # lazy greedy: the uncovered part of a tile can only shrink, so its last gain is an upper bound. The uncovered
+        # part of a tile is only updated with the tiles selected since its last update (and intersecting it).
+        # The tiles are selected until the part of the area of interest outside of all the selected tiles is within
+        # COVERAGE_TOLERANCE. The sum of the gains is only an estimate of the covered part (the areas of the pieces do
+        # not add up exactly), so when it reaches the tolerance the uncovered part is measured on its geometry.
+        remaining = list(pieces)
+        updated = np.zeros(len(candidates), dtype=int)
+        heap = [(-fractions[i], i) for i in range(len(candidates)) if fractions[i] > 0]
+        heapq.heapify(heap)
+        uncovered_fraction = 1.0
+        selected = []
+        while heap:
+            if uncovered_fraction <= COVERAGE_TOLERANCE:
+                covered = shapely.union_all(self.geometries[candidates[selected]])
+                uncovered_fraction = equal_area(shapely.difference(aoi, covered)) / total
+                if uncovered_fraction <= COVERAGE_TOLERANCE:
+                    break
+
+            _, i = heapq.heappop(heap)
+            tiles = self.geometries[candidates[selected[updated[i]:]]]
+            tiles = tiles[shapely.intersects(tiles, remaining[i])]
+            if len(tiles):
+                remaining[i] = shapely.difference(remaining[i], shapely.union_all(tiles))
+            updated[i] = len(selected)
+
+            gain = equal_area(remaining[i]) / total
+            if heap and gain < -heap[0][0]:
+                heapq.heappush(heap, (-gain, i))
+                continue
+            if gain <= 0:
+                break
+            selected.append(i)
+            uncovered_fraction -= gain
+
+        return [(int(self.paths[candidates[i]]), int(self.rows[candidates[i]]), float(fractions[i]))
+                for i in selected]
+
+
+_wrs_index = None
+_wrs_index_lock = threading.Lock()
+
+
+def get_wrs_index():
+    # the index is built lazily on first use (the shapefile is downloaded if needed) and shared by the whole process
+    global _wrs_index
+    if _wrs_index is None:
+        with _wrs_index_lock:
+            if _wrs_index is None:
+                _wrs_index = WRSIndex(download_wrs_shapefile())
+    return _wrs_index
+
 
+def get_path_row(lat, lon):
     # get all the paths and rows form the features intersecting with the point
-    list_of_paths_and_rows = []
-    i = 0
-    while layer.GetFeature(i) is not None:
-        if checkPoint(layer.GetFeature(i), point, mode):
-            feature = layer.GetFeature(i)
-            path = feature['PATH']
-            row = feature['ROW']
-            list_of_paths_and_rows.append((path, row))
-        i += 1
+    return get_wrs_index().path_rows(lat, lon)
 
-    return list_of_paths_and_rows
 
+def get_path_rows(points):
+    # batched version of get_path_row for a list of (lat, lon)
+    return get_wrs_index().path_rows_many(points)
 
-# ---------------------------------------------------- AWS get data ----------------------------------------------------
-import requests
-from bs4 import BeautifulSoup
-import shutil
 
+def get_country(location):
+    # name (ADMIN) and shape of the country in countries.geojson matching the location (case insensitive), or None
+    countries = get_countries()
+    matches = countries.loc[countries['ADMIN'].str.casefold() == str(location).strip().casefold()]
+    if matches.empty:
+        return None
+    return matches['ADMIN'].iloc[0], shapely.union_all(matches.geometry.values)
+
+
+def get_aoi_coverage(aoi, minimal=True):
+    # path/rows covering a polygon (lon/lat) with their fractions of the polygon: [(path, row, fraction), ...]
+    return get_wrs_index().coverage(aoi, minimal=minimal)
 
-def get_bands_data(scenes, list_of_file_suffix):
-    for i, scene in scenes.iterrows():
-        # Request the html text of the download_url from the amazon server.
-        response = requests.get(scene.download_url)
 
-        # Check the status code works
-        if response.status_code == 200:
+# ------------------------------------------ Selecting the complementary scenes ----------------------------------------
+def select_complementary_scenes(scenes, scene_productId, by='index', tie_break=None):
+    # For every path/row other than the one of the selected scene, get the scene which is the closest to the selected
+    # one, either by its position in the list of scenes sorted by date (by='index') or by acquisition time (by='time').
+    # Scenes at the same distance are ordered by tie_break (e.g. 'cloudCover') and then by their position.
+    # The complementary scenes are returned ordered by distance, followed by the selected scene.
+    product_ids = scenes['productId'].to_numpy()
+    selected = np.flatnonzero(product_ids == scene_productId)
+    if len(selected) == 0:
+        return scenes.iloc[[]]
+    selected = selected[0]
 
-            # Import the html to beautiful soup
-            html = BeautifulSoup(response.content, 'html.parser')
+    index = scenes['Index'].to_numpy() if 'Index' in scenes else np.arange(len(scenes))
+    groups = scenes['index_for_path_and_row'].to_numpy()
+
+    if by == 'time':
+        dates = pd.to_datetime(scenes['acquisitionDate']).to_numpy()
+        distance = np.abs(dates - dates[selected])
+    else:
+        distance = np.abs(index - index[selected])
+
+    # sort by path/row, then distance (then tie_break, then position) and keep the first scene of every path/row
+    keys = [index, distance, groups]
+    if tie_break is not None:
+        keys.insert(1, scenes[tie_break].to_numpy())
+    order = np.lexsort(keys)
+    first_of_group = np.ones(len(order), dtype=bool)
+    first_of_group[1:] = groups[order][1:] != groups[order][:-1]
+    closest = order[first_of_group & (groups[order] != groups[selected])]
+
+    # order the complementary scenes by distance (then tie_break, then position) as well
+    closest = closest[np.lexsort([key[closest] for key in keys[:-1]])]
+
+    return scenes.iloc[np.append(closest, selected)]
+
+
+# weights of the score of a scene in a set: days between the scene and the first scene of the set, and cloud cover (%)
+DATE_WEIGHT = 1.0
+CLOUD_WEIGHT = 1.0
+
+# number of candidate sets scored at the same time (memory: ANCHOR_CHUNK x number of scenes)
+ANCHOR_CHUNK = 256
+
+
+def rank_scene_sets(scenes, max_cloud_cover=None, target_date=None, date_weight=DATE_WEIGHT,
+                    cloud_weight=CLOUD_WEIGHT):
+    # Rank the sets of scenes covering all the path/rows of the scenes (one scene per path/row, index_for_path_and_row).
+    # Every scene is the first scene (anchor) of one candidate set; for every other path/row the set takes the scene with
+    # the lowest score: date_weight * days from the anchor + cloud_weight * cloud cover. The score of a set is the sum
+    # of the scores of its scenes (plus date_weight * days between the anchor and target_date when it is given).
+    # Scenes with a cloud cover above max_cloud_cover (or unknown, < 0) are not used.
+    # Returns (scores, members): the score of every complete set (sorted, best first, every set of scenes only once) and
+    # the positions of its scenes (one row per set, one column per path/row); no rows if no set covers all the
+    # path/rows.
+    groups_all = scenes['index_for_path_and_row'].to_numpy()
+    group_ids = np.unique(groups_all)
+
+    cloud = scenes['cloudCover'].to_numpy(dtype='float64')
+    cloud = np.where(cloud < 0, np.inf, cloud)
+    usable = np.ones(len(scenes), dtype=bool) if max_cloud_cover is None else cloud <= max_cloud_cover
+    usable &= np.isfinite(cloud)
+
+    positions = np.flatnonzero(usable)
+    if len(positions) == 0 or len(np.unique(groups_all[positions])) < len(group_ids):
+        return np.empty(0), np.empty((0, len(group_ids)), dtype=int)
+
+    # usable scenes sorted by path/row, start of every path/row in that order
+    positions = positions[np.argsort(groups_all[positions], kind='stable')]
+    groups = groups_all[positions]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    days = pd.to_datetime(scenes['acquisitionDate']).to_numpy()[positions].astype('datetime64[s]').astype('float64')
+    days /= 86400
+    cloud = cloud[positions]
+
+    all_scores, all_members = [], []
+    for chunk in range(0, len(positions), ANCHOR_CHUNK):
+        anchors = np.arange(chunk, min(chunk + ANCHOR_CHUNK, len(positions)))
+
+        # score of every scene for every anchor (one row per anchor)
+        score = date_weight * np.abs(days[None, :] - days[anchors, None]) + cloud_weight * cloud[None, :]
+
+        # best scene of every path/row for every anchor, the anchor itself for its own path/row
+        anchor_group = np.searchsorted(starts, anchors, side='right') - 1
+        score[np.arange(len(anchors)), anchors] = -np.inf
+        best = np.empty((len(anchors), len(starts)), dtype=int)
+        for k, (start, stop) in enumerate(zip(starts, np.r_[starts[1:], len(positions)])):
+            best[:, k] = start + np.argmin(score[:, start:stop], axis=1)
+        best_score = np.take_along_axis(score, best, axis=1)
+        best_score[np.arange(len(anchors)), anchor_group] = cloud_weight * cloud[anchors]
+
+        total = best_score.sum(axis=1)
+        if target_date is not None:
+            target = np.datetime64(pd.Timestamp(target_date), 's').astype('float64') / 86400
+            total += date_weight * np.abs(days[anchors] - target)
+
+        all_scores.append(total)
+        all_members.append(positions[best])
+
+    scores = np.concatenate(all_scores)
+    members = np.concatenate(all_members)
+
+    # the same set is found from several anchors (every scene of the set may be its anchor, scenes with the same date
+    # and cloud cover are interchangeable): every set of productIds is kept once, with its best score
+    product_ids = scenes['productId'].to_numpy()
+    seen = set()
+    unique = []
+    for i in np.argsort(scores, kind='stable'):
+        key = frozenset(product_ids[members[i]])
+        if key not in seen:
+            seen.add(key)
+            unique.append(i)
+    unique = np.array(unique, dtype=int)
+    return scores[unique], members[unique]
+
+
+def select_best_scenes(scenes, max_cloud_cover=None, target_date=None):
+    # the best set of scenes covering all the path/rows (see rank_scene_sets), ordered by acquisition date; no scenes
+    # if no set of scenes below the cloud cover threshold covers all the path/rows
+    scores, members = rank_scene_sets(scenes, max_cloud_cover, target_date)
+    if len(scores) == 0:
+        return scenes.iloc[[]]
+
+    best = scenes.iloc[np.unique(members[0])]
+    return best.sort_values('acquisitionDate', kind='stable')
+
+
+# ---------------------------------------------------- AWS get data ----------------------------------------------------
+# number of files downloaded at the same time, and number of attempts for every file
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_BACKOFF = 1  # seconds, doubled after every failed attempt
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    # one session (and pool of connections) shared by all the downloads of the process
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                retry = Retry(total=3, backoff_factor=DOWNLOAD_BACKOFF, status_forcelist=[500, 502, 503, 504],
+                              allowed_methods=['GET', 'HEAD'])
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_WORKERS, max_retries=retry)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _http_session = session
+    return _http_session
+
+
+def get_band_files(scene, list_of_file_suffix, session=None):
+    # names of the files of a scene which end with one of the suffixes, found in the index.html of the scene
+    from bs4 import BeautifulSoup
+
+    session = session or get_http_session()
+
+    # Request the html text of the download_url from the amazon server.
+    response = session.get(scene.download_url, timeout=60)
+
+    # Check the status code works
+    if response.status_code != 200:
+        return []
+
+    # Import the html to beautiful soup
+    html = BeautifulSoup(response.content, 'html.parser')
+
+    filenames = []
+    for li in html.find_all('li'):
+        filename = li.a['href']
+
+        # check if the last 6 items in file name are in the strings we want
+        if filename[-6:] in list_of_file_suffix:
+            filenames.append(filename)
+    return filenames
+
+
+def _md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _download_part(url, part_path, session):
+    # download (the rest of) the file into part_path, returns the expected size and ETag of the file
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 416:
+            # the part may already be complete, otherwise it is downloaded again
+            head = session.head(url, timeout=60)
+            head.raise_for_status()
+            size = int(head.headers.get('Content-Length', -1))
+            if size != offset:
+                os.remove(part_path)
+                raise IOError("Could not resume the download of {}".format(url))
+            return size, head.headers.get('ETag', '')
+
+        response.raise_for_status()
+        if response.status_code == 206:
+            # resuming: the server sends the remaining bytes, Content-Range ends with the size of the whole file
+            size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+            mode = 'ab'
+        else:
+            size = int(response.headers.get('Content-Length', -1))
+            mode = 'wb'
+
+        with open(part_path, mode) as output:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                output.write(chunk)
+
+        return size, response.headers.get('ETag', '')
+
+
+def download_file(url, file_path, session=None, attempts=DOWNLOAD_ATTEMPTS):
+    # Download a file with retries, resuming the partial file (HTTP Range) of the previous attempts.
+    # The size is checked against the one announced by the server, and the content against the ETag when it is the md5
+    # of the file (S3 objects which were not uploaded in multiple parts). The file only appears once it is complete.
+    # Every call writes its own partial file (several processes or jobs may download the same band at the same time),
+    # the last complete one replaces the others.
+    import requests
+
+    session = session or get_http_session()
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(file_path) or '.', prefix=os.path.basename(file_path) + '.',
+                                     suffix='.part', delete=False) as part:
+        part_path = part.name
+
+    for attempt in range(1, attempts + 1):
+        try:
+            size, etag = _download_part(url, part_path, session)
+
+            if size >= 0 and os.path.getsize(part_path) != size:
+                raise IOError("Incomplete download of {}: {} of {} bytes".format(url, os.path.getsize(part_path), size))
+
+            etag = etag.strip('"')
+            if len(etag) == 32 and '-' not in etag and _md5(part_path) != etag:
+                os.remove(part_path)
+                raise IOError("Checksum mismatch for {}".format(url))
+
+            os.replace(part_path, file_path)
+            return file_path
+
+        except (requests.RequestException, IOError) as e:
+            if attempt == attempts:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            print("---- Download of {} failed ({}), retrying".format(url, e))
+            time.sleep(DOWNLOAD_BACKOFF * 2 ** (attempt - 1))
+
+
+def get_bands_data(scenes, list_of_file_suffix, max_workers=DOWNLOAD_WORKERS):
+    # Download the bands of all the scenes into the band cache, in parallel (scenes x bands) and with one pool of HTTP
+    # connections. The bands which are already in the cache are not downloaded again.
+    # Returns the paths of the bands in the cache for every scene: {productId: [paths]}.
+    session = get_http_session()
+    cache = get_band_cache()
+
+    bands = dict()
+    scenes_to_list = []
+    for i, scene in scenes.iterrows():
+        # the files of a scene are named <productId>_<suffix>, so the index.html of the scene is only needed when
+        # some of them are not in the cache
+        cached = [cache.get_band(scene.productId, '{}_{}'.format(scene.productId, suffix))
+                  for suffix in list_of_file_suffix]
+        if all(cached):
+            bands[scene.productId] = cached
+        else:
+            scenes_to_list.append(scene)
 
-            # Create the dir where we will put this image files
-            entity_dir = os.path.join('./L8_raw_data', scene.productId)
-            os.makedirs(entity_dir, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        listings = pool.map(lambda scene: get_band_files(scene, list_of_file_suffix, session), scenes_to_list)
 
-            # Second loop: for each band of this image that we find using the html <li> tag
-            for li in html.find_all('li'):
+        downloads = []
+        for scene, filenames in zip(scenes_to_list, listings):
+            bands[scene.productId] = []
 
-                # Get the href tag - this links to other pages so we can go through
-                # several pages, as each date is its own page.
-                filename = li.a['href']  # find_next('a').get('href') #Go to each 'a' html tag and get the url, return string that is the file name
+            for filename in filenames:
+                file_path = cache.get_band(scene.productId, filename)
+                if file_path is None:
+                    # Create the dir where we will put this image files
+                    file_path = cache.band_path(scene.productId, filename)
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-                # check if the last 6 items in file name are in the strings we want
-                if filename[-6:] in list_of_file_suffix:
                     print('---- Downloading: {}'.format(filename))
                     # replace the index.html part of the url with the filename
-                    response = requests.get(scene.download_url.replace('index.html', filename), stream=True)
+                    url = scene.download_url.replace('index.html', filename)
+                    downloads.append(pool.submit(download_file, url, file_path, session))
+
+                bands[scene.productId].append(file_path)
+
+        # wait for all the downloads, an error of one of them is raised here
+        for future in concurrent.futures.as_completed(downloads):
+            future.result()
+
+    # keep the cache within its budget, without removing the bands of these scenes
+    cache.evict(keep={file_path for file_paths in bands.values() for file_path in file_paths})
+
+    return bands
+
+
+# ---------------------------------------------- GeoTIFF output profiles -----------------------------------------------
+# Creation options of the GeoTIFFs written by the app (masked bands and indicators): tiled in 512x512 blocks (windowed
+# reads only decode the blocks they need) and compressed with a predictor (horizontal differencing for the integer
+# bands, floating point predictor for the indicators). The 'cog' profile additionally rewrites the file as a
+# Cloud-Optimized GeoTIFF with overviews, so previews can be read from the overviews instead of the full raster.
+# The profiles are chosen in settings.MASK_OUTPUT_PROFILE and settings.INDICATOR_OUTPUT_PROFILE.
+
+OUTPUT_BLOCK_SIZE = 512
+
+OUTPUT_PROFILES = {
+    # striped and uncompressed, as written by the source images
+    'raw': {'tiled': False, 'compress': None},
+    'deflate': {'tiled': True, 'compress': 'deflate', 'options': {'zlevel': 6}},
+    'zstd': {'tiled': True, 'compress': 'zstd', 'options': {'zstd_level': 9}},
+    'cog': {'tiled': True, 'compress': 'deflate', 'options': {'zlevel': 6}, 'cog': True},
+}
+
+
+def get_output_profile(name):
+    try:
+        return OUTPUT_PROFILES[name]
+    except KeyError:
+        raise ValueError('Unknown output profile: {} (available: {})'.format(name, ', '.join(OUTPUT_PROFILES)))
+
+
+def output_meta(meta, profile):
+    # metadata of a new GeoTIFF (meta of rasterio.open) with the creation options of the profile
+    profile = get_output_profile(profile)
+    meta = {key: value for key, value in meta.items()
+            if key not in ('tiled', 'blockxsize', 'blockysize', 'compress', 'predictor')}
+    meta['driver'] = 'GTiff'
+
+    if profile['tiled']:
+        meta.update(tiled=True, blockxsize=OUTPUT_BLOCK_SIZE, blockysize=OUTPUT_BLOCK_SIZE)
+    if profile['compress']:
+        predictor = 3 if np.dtype(meta['dtype']).kind == 'f' else 2
+        meta.update(compress=profile['compress'], predictor=predictor, **profile.get('options', {}))
+    return meta
+
+
+# The COG driver does not take the creation options of the GTiff driver: the compression levels (zlevel, zstd_level)
+# are its LEVEL option, and the options it does not know are ignored with a warning.
+COG_OPTION_NAMES = {'zlevel': 'LEVEL', 'zstd_level': 'LEVEL'}
+COG_CREATION_OPTIONS = ('COMPRESS', 'LEVEL', 'PREDICTOR', 'BLOCKSIZE', 'OVERVIEW_RESAMPLING')
+
 
-                    # Download the files
-                    # code from: https://stackoverflow.com/a/18043472/5361345
+def cog_options(profile, dtype):
+    # creation options of the COG driver for a profile and a data type
+    kind = np.dtype(dtype).kind
+    options = {
+        'COMPRESS': profile['compress'].upper(),
+        'PREDICTOR': 3 if kind == 'f' else 2,
+        'BLOCKSIZE': OUTPUT_BLOCK_SIZE,
+        'OVERVIEW_RESAMPLING': 'AVERAGE' if kind == 'f' else 'NEAREST',
+    }
+    for key, value in profile.get('options', {}).items():
+        options[COG_OPTION_NAMES.get(key, key.upper())] = value
+    return {key: value for key, value in options.items() if key in COG_CREATION_OPTIONS}
 
-                    with open(os.path.join(entity_dir, filename), 'wb') as output:
-                        shutil.copyfileobj(response.raw, output)
-                    del response
+
+def finish_output(file_path, profile):
+    # GeoTIFFs of a COG profile are rewritten (in place) as Cloud-Optimized GeoTIFF with overviews
+    import rasterio
+    import rasterio.shutil
+
+    profile = get_output_profile(profile)
+    if not profile.get('cog'):
+        return file_path
+
+    with rasterio.open(file_path) as src:
+        dtype = src.dtypes[0]
+
+    cog_path = file_path + '.cog'
+    rasterio.shutil.copy(file_path, cog_path, driver='COG', **cog_options(profile, dtype))
+    os.replace(cog_path, file_path)
+    return file_path
 
 
 # ----------------------------------------- Masking data (bands) with shapefile ----------------------------------------
-import glob
-import rasterio.mask
-import geopandas as gpd
+_countries = None
+_countries_lock = threading.Lock()
 
 
-def mask_bands(location):
-    geoms = gpd.read_file('countries.geojson')
-    geoms = geoms.loc[geoms['ADMIN'] == location]
+def get_countries():
+    # the shapes of the countries are read once per process
+    global _countries
+    if _countries is None:
+        with _countries_lock:
+            if _countries is None:
+                import geopandas as gpd
+                _countries = gpd.read_file('countries.geojson')
+    return _countries
 
-    for filepath in glob.glob('./L8_raw_data/*/*.TIF'):
-        # Opening file
-        print("---- Masking: {}".format(filepath[14:]))
-        band = rasterio.open(filepath)
 
-        # Changing CRS of GeoJson to the one of the bands
-        geoms = geoms.to_crs(band.crs)
+@functools.lru_cache(maxsize=64)
+def get_mask_geometry(location, crs, resolution):
+    # Shape of the country in the CRS of the bands (given as WKT), simplified with a tolerance of half a pixel of the
+    # bands (the rasterization is much faster) and prepared. The simplified border is within half a pixel of the
+    # border, so only the pixels whose centre is within half a pixel of the border can be masked differently. All the
+    # bands of the scenes of a UTM zone share the same geometry.
+    countries = get_countries()
+    geoms = countries.loc[countries['ADMIN'] == location].to_crs(crs)
+    if geoms.empty:
+        raise ValueError('Unknown location: {}'.format(location))
 
-        # Masking && cropping
-        out_image, out_transform = rasterio.mask.mask(band, geoms.geometry, crop=True)
+    geometry = shapely.union_all(geoms.geometry.values)
+    geometry = geometry.simplify(resolution / 2, preserve_topology=True)
+    shapely.prepare(geometry)
+    return geometry
 
-        # Metadata is copied from the source image to the output image
-        out_meta = band.meta
 
-        # Update the metadata of the image to reduce the shape to the size of the mask
-        out_meta.update({"driver": "GTiff",
-                         "height": out_image.shape[1],
-                         "width": out_image.shape[2],
-                         "transform": out_transform})
+def scene_path_row(product_id):
+    # path/row of a scene from its productId (e.g. LC08_L1TP_190027_20200101_..._T1 -> '190027')
+    parts = str(product_id).split('_')
+    return parts[2] if len(parts) > 2 and parts[2].isdigit() else 'unknown'
+
+
+def mask_key(location, crs, transform, shape):
+    # key of a mask in the mask cache; the version of countries.geojson is part of it (see jobs.geometry_digest)
+    from .jobs import geometry_digest
+
+    key = [geometry_digest(location), crs, list(transform)[:6], list(shape)]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+# rows of a mask rasterized at once
+MASK_BLOCK_ROWS = 1024
+
+
+def get_mask_file(location, path_row, crs, transform, shape, geometry):
+    # Path of the mask of a grid (True outside of the country) in the mask cache. The masks are the same for all the
+    # scenes of a path/row (same grid), so they are rasterized once, a block of rows at a time. The bits are packed
+    # along the rows (shape (rows, ceil(columns / 8))), so a block of rows can be read from the memory-mapped file.
+    import rasterio.features
+    import rasterio.windows
+
+    cache = get_mask_cache()
+    key = mask_key(location, crs, transform, shape)
+    mask_path = cache.get_mask(path_row, key)
+    if mask_path is not None:
+        return mask_path
 
-        # Write masked image to TIF file
-        name = filepath
-        with rasterio.open(name, "w", **out_meta) as dest:
-            dest.write(out_image)
+    height, width = shape
+    mask_path = cache.mask_path(path_row, key)
+    tmp_path = cache.tmp_path(mask_path)
+    bits = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='uint8', shape=(height, (width + 7) // 8))
+    for row_off in range(0, height, MASK_BLOCK_ROWS):
+        window = rasterio.windows.Window(0, row_off, width, min(MASK_BLOCK_ROWS, height - row_off))
+        outside = rasterio.features.geometry_mask([geometry], out_shape=(window.height, window.width),
+                                                  transform=rasterio.windows.transform(window, transform))
+        bits[window.toslices()[0]] = np.packbits(outside, axis=1)
+    bits.flush()
+    del bits
 
+    cache.publish(tmp_path, mask_path)
+    return mask_path
 
-# ------------------------------------------------ Indicator computation -----------------------------------------------
-import numpy as np
-import matplotlib.pyplot as plt
-import base64
-from io import BytesIO
-import os
 
+def read_mask(mask_path, window):
+    # boolean mask (True outside of the country) of a window of the grid of a mask file, only the rows of the window
+    # are read
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    bits = np.load(mask_path, mmap_mode='r')[row_off:row_off + int(window.height)]
+    return np.unpackbits(bits, axis=1, count=col_off + int(window.width))[:, col_off:].view(bool)
 
-def get_graph():
-    buffer = BytesIO()
-    plt.savefig(buffer, format='png')
-    buffer.seek(0)
-    image_png = buffer.getvalue()
-    graph = base64.b64encode(image_png)
-    graph = graph.decode('utf-8')
-    buffer.close()
-    return graph
-
-
-def compute_indicator(path, indicator):
-    i = 1
-    for folder_path in glob.glob(path+'*'):
-        # initialize graph (overwritten after computation)
-        graph = ""
-
-        # Read the images using matplotlib
-        path_of_b4 = ""
-        path_of_b5 = ""
-        path_of_b6 = ""
-        path_of_b7 = ""
-
-        for item in os.listdir(folder_path):
-            if item.endswith('B4.TIF'):
-                path_of_b4 = os.path.join(folder_path, item)
-            if item.endswith('B5.TIF'):
-                path_of_b5 = os.path.join(folder_path, item)
-            if item.endswith('B6.TIF'):
-                path_of_b6 = os.path.join(folder_path, item)
-            if item.endswith('B7.TIF'):
-                path_of_b7 = os.path.join(folder_path, item)
-        band4 = plt.imread(path_of_b4)
-        band5 = plt.imread(path_of_b5)
-        band6 = plt.imread(path_of_b6)
-        band7 = plt.imread(path_of_b7)
-
-        # selecting the right computation according to the selected indicator by the user
-    # ----------------------------- NDVI (Normalized Difference Vegetation Index) computation ------------------------------
-        if indicator == 'NDVI':
-            print('---- Computing NDVI')
-
-            # Set the data type to int32 to account for any values that will go beyond the 16-bit range. Turn images into arrays in order to make the NDVI calculation.
-            red = np.array(band4, dtype="int32")
-            nir = np.array(band5, dtype="int32")
-
-            # Calculate NDVI. Need to account for possible 0 division error, so if the denominator equals 0, then consider the result as 0.
-            numerator = np.subtract(nir, red)
-            denominator = np.add(red, nir)
-            ndvi = np.true_divide(numerator, denominator, where=denominator != 0)
-
-            # Truncate values below 0 to 0. Do this because the NDVI values below 0 are not important ecologically.
-            ndvi[ndvi < 0] = 0
-
-            # Turn 0s into nans to get clear background in the image
-            ndvi_nan = ndvi.copy()
-            ndvi_nan[np.where(abs(red) == 0)] = np.nan  # Turns all the values that are 0 to nan, this makes the picture clearer (removes background)
-            ndvi32 = ndvi_nan.astype("float32")
-
-            # writing the NDVI image
-            print("writing the NDVI image...")
-            b4 = rasterio.open(path_of_b4)
-            meta = b4.meta
-            meta.update(driver='GTiff')
-            meta.update(dtype=rasterio.float32)
-
-            with rasterio.open('./L8_raw_data/OUTPUT' + str(i) + '.tiff', 'w', **meta) as dst:
-                dst.write(ndvi32, 1)
-
-            i += 1
-
-    # -------------------------------- NDWI (Normalized Difference Water Index) computation --------------------------------
-        elif indicator == 'NDWI':
-            print('---- Computing NDWI')
-
-            # Set the data type to int32 to account for any values that will go beyond the 16-bit range. Turn images into arrays in order to make the NDWI calculation.
-            nir = np.array(band5, dtype="int32")
-            swir = np.array(band6, dtype="int32")
-
-            # Calculate NDWI. Need to account for possible 0 division error, so if the denominator equals 0, then consider the result as 0.
-            numerator = np.subtract(nir, swir)
-            denominator = np.add(swir, nir)
-            ndwi = np.true_divide(numerator, denominator, where=denominator != 0)
-
-            # Truncate values below 0 to 0. Do this because the NDWI values below 0 are not important ecologically.
-            ndwi[ndwi < 0] = 0
-
-            # Turn 0s into nans to get clear background in the image
-            ndwi_nan = ndwi.copy()
-            ndwi_nan[np.where(abs(swir) == 0)] = np.nan  # Turns all the values that are 0 to nan, this makes the picture clearer (removes background)
-            ndwi32 = ndwi_nan.astype("float32")
-
-            # writing the NDWI image
-            print("writing the NDWI image...")
-            b4 = rasterio.open(path_of_b4)
-            meta = b4.meta
-            meta.update(driver='GTiff')
-            meta.update(dtype=rasterio.float32)
-
-            with rasterio.open('./L8_raw_data/OUTPUT' + str(i) + '.tiff', 'w', **meta) as dst:
-                dst.write(ndwi32, 1)
-
-            i += 1
-
-    # -------------------------------- NDSI (Normalized Difference Soil Index) computation ---------------------------------
-        elif indicator == 'NDSI':
-            print('---- Computing NDSI')
-
-            # Set the data type to int32 to account for any values that will go beyond the 16-bit range. Turn images into arrays in order to make the NDSI calculation.
-            nir = np.array(band5, dtype="int32")
-            swir = np.array(band6, dtype="int32")
-
-            # Calculate NDSI. Need to account for possible 0 division error, so if the denominator equals 0, then consider the result as 0.
-            numerator = np.subtract(swir, nir)
-            denominator = np.add(swir, nir)
-            ndsi = np.true_divide(numerator, denominator, where=denominator != 0)
-
-            # Truncate values below 0 to 0. Do this because the NDSI values below 0 are not important ecologically.
-            ndsi[ndsi < 0] = 0
-
-            # Turn 0s into nans to get clear background in the image
-            ndsi_nan = ndsi.copy()
-            ndsi_nan[np.where(abs(nir) == 0)] = np.nan  # Turns all the values that are 0 to nan, this makes the picture clearer (removes background)
-            ndsi32 = ndsi_nan.astype("float32")
-
-            # writing the NDSI image
-            print("writing the NDSI image...")
-            b4 = rasterio.open(path_of_b4)
-            meta = b4.meta
-            meta.update(driver='GTiff')
-            meta.update(dtype=rasterio.float32)
-
-            with rasterio.open('./L8_raw_data/OUTPUT' + str(i) + '.tiff', 'w', **meta) as dst:
-                dst.write(ndsi32, 1)
 
-            i += 1
+def get_mask(location, path_row, crs, transform, shape, geometry):
+    # boolean mask of a whole grid (True outside of the country), from the mask cache
+    import rasterio.windows
 
-    # ------------------------------- SLAVI (Specific Leaf Area Vegetation Index) computation ------------------------------
-        elif indicator == 'SLAVI':
-            print('---- Computing SLAVI')
+    mask_path = get_mask_file(location, path_row, crs, transform, shape, geometry)
+    return read_mask(mask_path, rasterio.windows.Window(0, 0, shape[1], shape[0]))
+
+
+def read_masked(src, geometry, location, path_row):
+    # Read only the window of the band around the geometry, the pixels outside of the geometry are set to nodata (0 if
+    # the band has none). Returns the data and its transform.
+    import rasterio.features
+
+    window = rasterio.features.geometry_window(src, [geometry])
+    data = src.read(window=window)
+    transform = src.window_transform(window)
+
+    outside = get_mask(location, path_row, src.crs.to_wkt(), transform, data.shape[1:], geometry)
+    data = np.where(outside, np.asarray(src.nodata or 0, dtype=data.dtype), data)
+    return data, transform
+
+
+def mask_bands(location, bands, profile=None):
+    # Mask the bands of every scene ({productId: [paths]}) with the shape of the country. The masked bands are written
+    # next to the original ones in the band cache (the original bands are not modified), with the output profile
+    # (settings.MASK_OUTPUT_PROFILE by default).
+    # Returns the paths of the masked bands for every scene: {productId: [paths]}.
+    import rasterio
+
+    cache = get_band_cache()
+    profile = profile or getattr(settings, 'MASK_OUTPUT_PROFILE', 'deflate')
 
-            # Set the data type to int32 to account for any values that will go beyond the 16-bit range. Turn images into arrays in order to make the SLAVI calculation.
-            red = np.array(band4, dtype="int32")
-            nir = np.array(band5, dtype="int32")
-            swir = np.array(band6, dtype="int32")
+    masked_bands = dict()
+    for product_id, file_paths in bands.items():
+        masked_bands[product_id] = []
 
-            # Calculate SLAVI. Need to account for possible 0 division error, so if the denominator equals 0, then consider the result as 0.
-            numerator = nir
-            denominator = np.add(swir, red)
-            slavi = np.true_divide(numerator, denominator, where=denominator != 0)
+        for filepath in file_paths:
+            filename = os.path.basename(filepath)
+            masked_path = cache.get_band(product_id, filename, mask=location)
+            if masked_path is not None:
+                masked_bands[product_id].append(masked_path)
+                continue
 
-            # Truncate values below 0 to 0. Do this because the SLAVI values below 0 are not important ecologically.
-            slavi[slavi < 0] = 0
+            print("---- Masking: {}".format(filename))
+            with rasterio.open(filepath) as band:
+                # Shape of the country in the CRS of the band
+                geometry = get_mask_geometry(location, band.crs.to_wkt(), abs(band.transform.a))
 
-            # Turn 0s into nans to get clear background in the image
-            slavi_nan = slavi.copy()
-            slavi_nan[np.where(abs(red) == 0)] = np.nan  # Turns all the values that are 0 to nan, this makes the picture clearer (removes background)
-            slavi32 = slavi_nan.astype("float32")
+                # Masking && cropping (only the window of the country is read, the mask of the grid of the path/row
+                # is cached)
+                out_image, out_transform = read_masked(band, geometry, location, scene_path_row(product_id))
 
-            # writing the SLAVI image
-            print("writing the SLAVI image...")
-            b4 = rasterio.open(path_of_b4)
-            meta = b4.meta
-            meta.update(driver='GTiff')
-            meta.update(dtype=rasterio.float32)
+                # Metadata is copied from the source image to the output image
+                out_meta = band.meta
 
-            with rasterio.open('./L8_raw_data/OUTPUT' + str(i) + '.tiff', 'w', **meta) as dst:
-                dst.write(slavi32, 1)
+            # Update the metadata of the image to reduce the shape to the size of the mask
+            out_meta.update({"height": out_image.shape[1],
+                             "width": out_image.shape[2],
+                             "transform": out_transform})
+
+            # Write masked image to a new TIF file in the cache
+            masked_path = cache.band_path(product_id, filename, mask=location)
+            tmp_path = cache.tmp_path(masked_path)
+            with rasterio.open(tmp_path, "w", **output_meta(out_meta, profile)) as dest:
+                dest.write(out_image)
+            finish_output(tmp_path, profile)
+
+            cache.publish(tmp_path, masked_path, keep=set(file_paths) | set(masked_bands[product_id]))
+            masked_bands[product_id].append(masked_path)
+
+    return masked_bands
+
+
+# ------------------------------------------------- Indicator registry -------------------------------------------------
+# Every indicator is a ratio of two linear combinations of bands: scale * (sum of coefficient * band + offset) / (sum
+# of coefficient * band + offset), with the bands as keys and the coefficients as values (the offsets and the scale
+# are optional). The background band is the one whose 0 values are outside of the image (nan in the result). Only the
+# bands used by an indicator are downloaded and read.
+# Adding an indicator is one entry in INDICATORS, e.g. 'NBR': normalized_difference('B5', 'B7', background='B5').
 
-            i += 1
+BandRatio = namedtuple('BandRatio', ['numerator', 'denominator', 'background', 'numerator_offset',
+                                     'denominator_offset', 'scale'], defaults=[0, 0, 1])
 
-    # ---------------------------------- NDRE (Normalized Difference Red Edge) computation ---------------------------------
-        elif indicator == 'NDRE':
-            print('---- Computing NDRE')
 
-            # Set the data type to int32 to account for any values that will go beyond the 16-bit range. Turn images into arrays in order to make the NDRE calculation.
-            nir = np.array(band5, dtype="int32")
-            swir2 = np.array(band7, dtype="int32")
+def normalized_difference(a, b, background):
+    # (a - b) / (a + b)
+    return BandRatio({a: 1, b: -1}, {a: 1, b: 1}, background)
 
-            # Calculate NDRE. Need to account for possible 0 division error, so if the denominator equals 0, then consider the result as 0.
-            numerator = np.subtract(nir, swir2)
-            denominator = np.add(swir2, nir)
-            ndre = np.true_divide(numerator, denominator, where=denominator != 0)
 
-            # Truncate values below 0 to 0. Do this because the NDRE values below 0 are not important ecologically.
-            ndre[ndre < 0] = 0
+def ratio(numerator_bands, denominator_bands, background):
+    # (sum of the numerator bands) / (sum of the denominator bands)
+    return BandRatio({band: 1 for band in numerator_bands}, {band: 1 for band in denominator_bands}, background)
 
-            # Turn 0s into nans to get clear background in the image
-            ndre_nan = ndre.copy()
-            ndre_nan[np.where(abs(nir) == 0)] = np.nan  # Turns all the values that are 0 to nan, this makes the picture clearer (removes background)
-            ndre32 = ndre_nan.astype("float32")
 
-            # writing the NDRE image
-            print("writing the NDRE image...")
-            b4 = rasterio.open(path_of_b4)
-            meta = b4.meta
-            meta.update(driver='GTiff')
-            meta.update(dtype=rasterio.float32)
+INDICATORS = {
+    # Normalized Difference Vegetation Index: (nir - red) / (nir + red)
+    'NDVI': normalized_difference('B5', 'B4', background='B4'),
+    # Normalized Difference Water Index: (nir - swir) / (nir + swir)
+    'NDWI': normalized_difference('B5', 'B6', background='B6'),
+    # Normalized Difference Soil Index: (swir - nir) / (swir + nir)
+    'NDSI': normalized_difference('B6', 'B5', background='B5'),
+    # Specific Leaf Area Vegetation Index: nir / (swir + red)
+    'SLAVI': ratio(['B5'], ['B6', 'B4'], background='B4'),
+    # Normalized Difference Red Edge: (nir - swir2) / (nir + swir2)
+    'NDRE': normalized_difference('B5', 'B7', background='B5'),
+    # Enhanced Vegetation Index: 2.5 * (nir - red) / (nir + 6 * red - 7.5 * blue + 1) on reflectances. The bands are
+    # digital numbers; the reflectance of every band of Landsat 8 is 2e-5 * band - 0.1 (without the sun angle
+    # correction), so the ratio is the same on the digital numbers with 1.05 / 2e-5 = 52500 in the denominator.
+    'EVI': BandRatio({'B5': 1, 'B4': -1}, {'B5': 1, 'B4': 6, 'B2': -7.5}, background='B4', denominator_offset=52500,
+                     scale=2.5),
+}
 
-            with rasterio.open('./L8_raw_data/OUTPUT' + str(i) + '.tiff', 'w', **meta) as dst:
-                dst.write(ndre32, 1)
 
-            i += 1
+def get_indicator(indicator):
+    try:
+        return INDICATORS[indicator]
+    except KeyError:
+        raise ValueError("Unknown indicator: {}".format(indicator))
 
 
-# -------------------------------------------- Plotting bands of all scenes --------------------------------------------
-import cartopy.crs as ccrs
-from rasterio.transform import from_origin
-from rasterio.warp import reproject, Resampling
+def required_bands(indicators):
+    # bands used by an indicator (or a list of indicators), e.g. ['B4', 'B5'] for NDVI
+    if isinstance(indicators, str):
+        indicators = [indicators]
 
+    bands = set()
+    for indicator in indicators:
+        formula = get_indicator(indicator)
+        bands |= set(formula.numerator) | set(formula.denominator) | {formula.background}
+    return sorted(bands)
 
-def plotting_image(location):
-    geoms = gpd.read_file('countries.geojson')
-    shapefile = geoms.loc[geoms['ADMIN'] == location]
 
-    xmin, xmax, ymin, ymax = [], [], [], []
+def band_file_suffixes(indicators):
+    # suffixes of the files of the bands used by an indicator or a list of indicators (for get_bands_data),
+    # e.g. ['B4.TIF', 'B5.TIF']
+    return ['{}.TIF'.format(band) for band in required_bands(indicators)]
 
-    for image_path in glob.glob('L8_raw_data/OUTPUT*'):
-        with rasterio.open(image_path) as src_raster:
-            xmin.append(src_raster.bounds.left)
-            xmax.append(src_raster.bounds.right)
-            ymin.append(src_raster.bounds.bottom)
-            ymax.append(src_raster.bounds.top)
 
-    fig, ax = plt.subplots(1, 1, figsize=(20, 15), subplot_kw={'projection': ccrs.UTM(16)})
+def find_bands(file_paths, bands):
+    # path of the file of every band, e.g. {'B4': '.../LC08_..._B4.TIF'}
+    return {band: file_path for band in bands for file_path in file_paths if file_path.endswith('_{}.TIF'.format(band))}
 
-    ax.set_extent([min(xmin), max(xmax), min(ymin), max(ymax)], ccrs.UTM(16))
 
-    # somehow the shape is not plotted on the final image
-    shapefile.plot(ax=ax, transform=ccrs.PlateCarree())
+def linear_combination(terms, blocks, out, scratch=None, offset=0):
+    # out = sum of coefficient * block + offset, computed in place; the products by the coefficients other than 1 and
+    # -1 are computed into scratch (a buffer of the shape of out)
+    for n, (band, coefficient) in enumerate(terms.items()):
+        block = blocks[band]
+        if n == 0:
+            np.multiply(block, coefficient, out=out)
+        elif coefficient == 1:
+            np.add(out, block, out=out)
+        elif coefficient == -1:
+            np.subtract(out, block, out=out)
+        else:
+            if scratch is None:
+                scratch = np.empty_like(out)
+            np.multiply(block, coefficient, out=scratch)
+            np.add(out, scratch, out=out)
+    if offset:
+        np.add(out, offset, out=out)
+    return out
+
+
+def evaluate_indicator(formula, blocks, out, denominator, scratch=None):
+    # Compute an indicator on blocks of the bands ({band: float32 block}) into out, using denominator and scratch as
+    # scratch buffers. Division by 0 gives 0, values below 0 are set to 0 (they are not important ecologically) and
+    # the background is set to nan (clear background in the image).
+    linear_combination(formula.numerator, blocks, out, scratch, formula.numerator_offset)
+    linear_combination(formula.denominator, blocks, denominator, scratch, formula.denominator_offset)
+
+    zero = denominator == 0
+    np.divide(out, denominator, out=out, where=~zero)
+    out[zero] = 0
+    if formula.scale != 1:
+        np.multiply(out, formula.scale, out=out)
+    np.maximum(out, 0, out=out)
+    out[blocks[formula.background] == 0] = np.nan
+    return out
+
+
+# --------------------------------------------- Indicator computation (blocks) -----------------------------------------
+# number of rows read at once when the bands are stored in strips instead of tiles
+BLOCK_ROWS = 512
+
+
+def block_windows(src, block_rows=BLOCK_ROWS):
+    # windows to read a raster block by block; strips of one (or a few) rows are grouped to blocks of block_rows rows
+    # (block_rows=None gives one window with the whole raster)
+    import rasterio.windows
+
+    if block_rows is None:
+        yield rasterio.windows.Window(0, 0, src.width, src.height)
+        return
+
+    block_height, block_width = src.block_shapes[0]
+    if block_width < src.width:
+        for _, window in src.block_windows(1):
+            yield window
+        return
+
+    block_rows = max(block_rows, block_height)
+    for row_off in range(0, src.height, block_rows):
+        yield rasterio.windows.Window(0, row_off, src.width, min(block_rows, src.height - row_off))
+
+
+def compute_indicator_streaming(band_paths, indicators, output_path, block_rows=BLOCK_ROWS, profile=None):
+    # Compute one or several indicators block by block, in one pass over the bands: only the bands used by the
+    # indicators ({band: path}) are read, once per block, into preallocated float32 buffers; every indicator is computed
+    # into a preallocated buffer and written right away, so only a few blocks are in memory at the same time.
+    # output_path is either one path (one band per indicator, in the order of indicators) or {indicator: path}.
+    # The outputs are written with the output profile (settings.INDICATOR_OUTPUT_PROFILE by default).
+    if isinstance(indicators, str):
+        indicators = [indicators]
+    import rasterio
+
+    profile = profile or getattr(settings, 'INDICATOR_OUTPUT_PROFILE', 'cog')
+    formulas = [get_indicator(indicator) for indicator in indicators]
+
+    sources = {band: rasterio.open(band_paths[band]) for band in required_bands(indicators)}
+    destinations = []
+    try:
+        first = sources[formulas[0].background]
+        meta = output_meta(dict(first.meta, dtype=rasterio.float32, count=1), profile)
 
-    for image_path in glob.glob('L8_raw_data/OUTPUT*'):
-        with rasterio.open(image_path) as src_raster:
-            extent = [src_raster.bounds[i] for i in [0, 2, 1, 3]]
+        # (dataset, band index) to write every indicator to
+        if isinstance(output_path, dict):
+            for indicator in indicators:
+                destinations.append((rasterio.open(output_path[indicator], 'w', **meta), 1))
+        else:
+            meta.update(count=len(indicators))
+            dst = rasterio.open(output_path, 'w', **meta)
+            destinations = [(dst, k) for k in range(1, len(indicators) + 1)]
+        for (dst, k), indicator in zip(destinations, indicators):
+            dst.set_band_description(k, indicator)
+
+        windows = list(block_windows(first, block_rows))
+        shape = (max(w.height for w in windows), max(w.width for w in windows))
+        read_buffers = {band: np.empty(shape, dtype='float32') for band in sources}
+        out_buffer = np.empty(shape, dtype='float32')
+        denominator_buffer = np.empty(shape, dtype='float32')
+        scratch_buffer = np.empty(shape, dtype='float32')
+
+        for window in windows:
+            size = (slice(0, window.height), slice(0, window.width))
+            blocks = {band: src.read(1, window=window, out=read_buffers[band][size])
+                      for band, src in sources.items()}
+            for formula, (dst, k) in zip(formulas, destinations):
+                out = evaluate_indicator(formula, blocks, out_buffer[size], denominator_buffer[size],
+                                         scratch_buffer[size])
+                dst.write(out, k, window=window)
+    finally:
+        for dst in {dst for dst, _ in destinations}:
+            dst.close()
+        for src in sources.values():
+            src.close()
+
+    for path in (output_path.values() if isinstance(output_path, dict) else [output_path]):
+        finish_output(path, profile)
+    return output_path
 
-            dst_transform = from_origin(src_raster.bounds.left, src_raster.bounds.top, 250, 250)
 
-            width = np.ceil((src_raster.bounds.right - src_raster.bounds.left) / 250.).astype('uint')
-            height = np.ceil((src_raster.bounds.top - src_raster.bounds.bottom) / 250.).astype('uint')
+# ------------------------------------------------ Indicator computation -----------------------------------------------
+def compute_indicator(bands, indicators, output_dir='./L8_raw_data', streaming=True, multiband=False, start=1,
+                      profile=None):
+    # Compute one indicator or a list of indicators for every scene ({productId: [paths of the masked bands]}), the bands
+    # are read once for all the indicators. With streaming the bands are processed block by block, otherwise the whole
+    # bands are read at once.
+    # Outputs: OUTPUT<i>.tiff per scene for one indicator; for several indicators either OUTPUT<i>.tiff with one band per
+    # indicator (multiband) or OUTPUT<i>_<indicator>.tiff per scene and indicator.
+    # The scenes are numbered from start (for scenes processed separately). The outputs are always new files, written
+    # with the output profile (settings.INDICATOR_OUTPUT_PROFILE by default).
+    # Returns the output files of every indicator: {indicator: [paths]}.
+    if isinstance(indicators, str):
+        indicators = [indicators]
+    os.makedirs(output_dir, exist_ok=True)
+
+    outputs = {indicator: [] for indicator in indicators}
+    for i, (product_id, file_paths) in enumerate(bands.items(), start):
+        band_paths = find_bands(file_paths, required_bands(indicators))
+
+        if len(indicators) == 1 or multiband:
+            output_path = os.path.join(output_dir, 'OUTPUT' + str(i) + '.tiff')
+            for indicator in indicators:
+                outputs[indicator].append(output_path)
+        else:
+            output_path = {indicator: os.path.join(output_dir, 'OUTPUT{}_{}.tiff'.format(i, indicator))
+                           for indicator in indicators}
+            for indicator in indicators:
+                outputs[indicator].append(output_path[indicator])
 
-            dst = np.zeros((height, width))
+        print('---- Computing {}'.format(', '.join(indicators)))
+        compute_indicator_streaming(band_paths, indicators, output_path,
+                                    block_rows=BLOCK_ROWS if streaming else None, profile=profile)
 
-            """I had to add src_crs and dst_crs in order for the re-project to work"""
-            reproject(src_raster.read(1), dst,
-                      src_crs=src_raster.crs,
-                      dst_crs=src_raster.crs,
-                      src_transform=src_raster.transform,
-                      dst_transform=dst_transform,
-                      resampling=Resampling.nearest)
+    return outputs
 
-            ax.matshow(np.ma.masked_equal(dst, 0), extent=extent, transform=ccrs.UTM(16))
 
-    fig.savefig('satellite_data_processing/static/multiple_bands_plot.png')
+# -------------------------------------------- Plotting bands of all scenes --------------------------------------------
+def plotting_image(location, image_paths, output_path):
+    # PNG mosaic of the computed images at output_path (in the result directory of the job), with the outline of the
+    # location (see mosaic.py)
+    from .mosaic import render_mosaic
+
+    geoms = get_countries()
+    shapefile = geoms.loc[geoms['ADMIN'] == location]
+
+    return render_mosaic(image_paths, output_path, outline=shapefile)
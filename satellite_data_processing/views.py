@@ -1,23 +1,32 @@
-from django.shortcuts import render, redirect
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
+from django.urls import reverse
+from django.utils.http import urlencode
+from django.shortcuts import render, redirect, get_object_or_404
 from .forms import *
-from geopy.geocoders import Nominatim
 from .utils import *
-import ee
-from folium import plugins
 from os import path
 
 
 # ------------------------------------------- AWS -------------------------------------------
-import pandas as pd
 from .models import *
+from .catalogue import get_catalogue
+from .selection import get_selection_key, load_selection, save_selection
+from .jobs import enqueue_job, fail_stale_jobs, get_job_pool, get_result_file, get_result_image, job_scenes
+from .disk_cache import get_result_cache
+from .geocoding import geocode
 
 
 def aws(request):
     location_form = FindLocationForm(request.POST or None)
     date_form = DatePickerForm(request.POST or None)
     indicator_choices_form = IndicatorChoiceForm(request.POST or None)
-
-    geolocator = Nominatim(user_agent='satellite_data_processing')
+    auto_select_form = AutoSelectForm(request.POST if 'auto_select' in request.POST else None)
+    time_series_form = TimeSeriesForm(request.POST if 'time_series' in request.POST else None, prefix='time_series')
 
 
 # -------------- initialize data when form is not valid --------------
@@ -27,13 +36,20 @@ def aws(request):
     ending_date = 0
     selected_scene = 0
     list_of_path_and_rows = []
+    path_row_coverage = []
     s = 0
+    scene_list_url = None
+    auto_select_error = None
+    time_series_error = None
+
+    selection_key = get_selection_key(request)
 
 
 # -------------- processing when forms are valid (user entered location and/or date range) --------------
     if indicator_choices_form.is_valid():
-        indicator = indicator_choices_form.cleaned_data.get('choices')
-        indicator_choices_form.save()
+        indicator = indicator_choices_form.cleaned_data.get('indicator')
+        if indicator:
+            save_selection(selection_key, indicator=indicator)
 
     if date_form.is_valid():
         starting_date = date_form.cleaned_data.get('starting_date')
@@ -41,48 +57,40 @@ def aws(request):
 
     if location_form.is_valid():
         location_ = location_form.cleaned_data.get('location')
-        location = geolocator.geocode(location_)
+        location = geocode(location_)
+
+        # a country of countries.geojson (the shape used for the masking) is covered with all its path/rows, with the
+        # name of the country as in countries.geojson
+        country = get_country(location_) if location_ else None
+        if country is not None:
+            location_ = country[0]
 
-        location_form.save()
+        if location_:
+            save_selection(selection_key, location=location_)
 
         if location is not None:
             # location coordinates
             location_lat = location.latitude
             location_lon = location.longitude
 
-            # get all paths an rows of the location
-            list_of_path_and_rows = get_path_row(location_lat, location_lon)
+            # get all paths an rows of the location (the minimal set of path/rows covering a country, otherwise the
+            # ones of the point)
+            if country is not None:
+                coverage = get_aoi_coverage(country[1])
+                list_of_path_and_rows = [(path_, row) for path_, row, _ in coverage]
+                path_row_coverage = [(path_, row, round(100 * fraction, 1)) for path_, row, fraction in coverage]
+            else:
+                list_of_path_and_rows = get_path_row(location_lat, location_lon)
+                path_row_coverage = [(path_, row, None) for path_, row in list_of_path_and_rows]
             print("---- list_of_path_and_rows:", list_of_path_and_rows)
 
-            list_of_scenes = []
-            # get all the scenes for the rows and paths
-            for item in list_of_path_and_rows:
-                path = item[0]
-                row = item[1]
-                all_scenes = pd.read_csv('scene_list.gz', compression='gzip')
-                scenes = all_scenes[(all_scenes.path == path) & (all_scenes.row == row) &
-                                    (~all_scenes.productId.str.contains('_T2')) &
-                                    (~all_scenes.productId.str.contains('_RT'))]
-                list_of_scenes.append(scenes)
-            scenes = pd.concat(list_of_scenes)
-
-            # get only the scenes within the dat range if a date range is entered
+            # get all the scenes for the rows and paths (within the date range if a date range is entered)
             if (starting_date is not None) and (ending_date is not None):
                 starting_date = str(starting_date)
                 ending_date = str(ending_date)
-
-                scenes = scenes.loc[(scenes['acquisitionDate'] > starting_date) & (scenes['acquisitionDate'] <= ending_date)]
-
-            # adding a column to the scenes dataframe which helps to get all the corresponding scenes after the user selects one scene
-            scenes_after_new_index = []
-            for i, item in enumerate(list_of_path_and_rows):
-                path = item[0]
-                row = item[1]
-                sc = scenes.loc[(scenes['path'] == path) & (scenes['row'] == row)]
-                sc['index_for_path_and_row'] = i
-                scenes_after_new_index.append(sc)
-
-            scenes = pd.concat(scenes_after_new_index)
+                scenes = get_catalogue().scenes_for_path_rows(list_of_path_and_rows, starting_date, ending_date)
+            else:
+                scenes = get_catalogue().scenes_for_path_rows(list_of_path_and_rows)
 
             s = scenes.sort_values('acquisitionDate')
             s.reset_index(drop=True, inplace=True)
@@ -90,49 +98,69 @@ def aws(request):
             # set the name of the index column to 'Index'
             s.index.names = ['Index']
 
-            s.to_csv("./scenes_in_date_range.csv")
+            save_selection(selection_key, scenes=s.reset_index())
+
+            # the table of the scenes is loaded page by page from the scene listing api
+            query = {'path_rows': format_path_rows(list_of_path_and_rows),
+                     'fields': 'productId,acquisitionDate,cloudCover'}
+            if starting_date and ending_date:
+                query.update(starting_date=starting_date, ending_date=ending_date)
+            scene_list_url = '{}?{}'.format(reverse('scene_list'), urlencode(query))
 
 
 # -------------- After scene is selected --------------
     if request.method == 'POST':
         scene_productId = request.POST.get('submit_scene')
         if scene_productId is not None:
-            scenes_csv = pd.read_csv('scenes_in_date_range.csv')
-            selected_scene = scenes_csv.loc[scenes_csv['productId'] == scene_productId]
+            scenes_in_date_range = load_selection(selection_key).get('scenes')
+            if scenes_in_date_range is None:
+                return redirect('aws')
+
+            # get the scenes which are closest to the selected scene, but have a different path-row combination,
+            # together with the selected scene
+            final_scenes = select_complementary_scenes(scenes_in_date_range, scene_productId)
 
-            list_of_idx = scenes_csv["Index"].to_list()
+            save_selection(selection_key, selected_scenes=final_scenes)
 
-            index_of_selected_scene = int(selected_scene['Index'])
+            # the scenes are processed in the background, the aws_img page shows the progress
+            selection = load_selection(selection_key)
+            job = enqueue_job(final_scenes, str(selection.get('location')), str(selection.get('indicator')))
 
-            # dict of distances between selected scene and other scenes in date range
-            dict_of_distances = dict()
-            for idx in list_of_idx:
-                distance = abs(idx - index_of_selected_scene)
-                dict_of_distances[idx] = distance
+            return redirect('aws_img', job_id=job.id)
 
-            # sort dict of distances according to the values (distance)
-            dict_of_distances = dict(sorted(dict_of_distances.items(), key=lambda item: item[1]))
-            del dict_of_distances[index_of_selected_scene]
+        # the best set of scenes covering all the path/rows (date proximity and cloud cover) is selected automatically
+        if 'auto_select' in request.POST and auto_select_form.is_valid():
+            selection = load_selection(selection_key)
+            scenes_in_date_range = selection.get('scenes')
+            if scenes_in_date_range is None:
+                return redirect('aws')
 
-            # get the scenes which are closest to the selected scene, but have a different path-row combination
-            list_of_final_scenes = []
-            idx_path_row_of_selected_scene = int(selected_scene['index_for_path_and_row'])
-            for idx, distance in dict_of_distances.items():
-                scene = scenes_csv.loc[scenes_csv['Index'] == idx]
-                idx_path_row_of_scene = int(scene['index_for_path_and_row'])
-                if idx_path_row_of_scene != idx_path_row_of_selected_scene:
-                    list_of_final_scenes.append(scene)
+            max_cloud_cover = auto_select_form.cleaned_data.get('max_cloud_cover')
+            final_scenes = select_best_scenes(scenes_in_date_range, max_cloud_cover)
+            if len(final_scenes):
+                save_selection(selection_key, selected_scenes=final_scenes)
+                job = enqueue_job(final_scenes, str(selection.get('location')), str(selection.get('indicator')))
+                return redirect('aws_img', job_id=job.id)
 
-            # concat all the corresponding scenes and only keep the first ones as they have the smallest distance
-            final_scenes = pd.concat(list_of_final_scenes)
-            final_scenes = final_scenes.drop_duplicates(subset='index_for_path_and_row', keep="first")
+            auto_select_error = 'No set of scenes with a cloud cover below {}% covers all the paths and rows.'.format(
+                max_cloud_cover)
 
-            # concat the corresponding scenes with the initial scene selected by the user
-            final_scenes = pd.concat([final_scenes, selected_scene])
+        # statistics of the indicator over the location for every date of all the scenes of the period (no image)
+        if 'time_series' in request.POST and time_series_form.is_valid():
+            selection = load_selection(selection_key)
+            scenes_in_date_range = selection.get('scenes')
+            if scenes_in_date_range is None:
+                return redirect('aws')
 
-            final_scenes.to_csv("./selected_scenes_in_date_range.csv")
+            max_cloud_cover = time_series_form.cleaned_data.get('max_cloud_cover')
+            if max_cloud_cover is not None:
+                scenes_in_date_range = scenes_in_date_range[scenes_in_date_range['cloudCover'] <= max_cloud_cover]
+            if len(scenes_in_date_range):
+                job = enqueue_job(scenes_in_date_range, str(selection.get('location')),
+                                  str(selection.get('indicator')), kind=Job.STATISTICS)
+                return redirect('aws_img', job_id=job.id)
 
-            return redirect('aws_img')
+            time_series_error = 'No scene of the period has a cloud cover below {}%.'.format(max_cloud_cover)
 
 
 # -------------- Variables passed to the template --------------
@@ -140,60 +168,155 @@ def aws(request):
         'location_form': location_form,
         'date_form': date_form,
         'indicator_choices_form': indicator_choices_form,
+        'auto_select_form': auto_select_form,
+        'auto_select_error': auto_select_error,
+        'time_series_form': time_series_form,
+        'time_series_error': time_series_error,
         'lat': location_lat,
         'lon': location_lon,
         'starting_date': starting_date,
         'ending_date': ending_date,
         'list_of_path_and_rows': list_of_path_and_rows,
+        'path_row_coverage': path_row_coverage,
         'scene': selected_scene,
-        'scenes': s
+        'scene_list_url': scene_list_url,
     }
 
     return render(request, 'aws.html', context)
 
 
-# ------------------------------------------- AWS IMG -------------------------------------------
-def aws_img(request):
-    selected_scenes = pd.read_csv('selected_scenes_in_date_range.csv')
+# ------------------------------------------- Scene listing API -------------------------------------------
+SCENE_PAGE_SIZE = 50
+MAX_SCENE_PAGE_SIZE = 500
+
 
-    # Fetch the latest location from the database
-    location = Location.objects.exclude(location__exact='').last().location
-    print("------------ location:", str(location))
+def format_path_rows(list_of_path_and_rows):
+    # [(190, 27), (189, 27)] -> '190-27,189-27'
+    return ','.join('{}-{}'.format(path_, row) for path_, row in list_of_path_and_rows)
 
-    # Fetch the latest indicator from the database
-    indicator = Indicator.objects.exclude(indicator__exact='').last().indicator
-    print("------------ indicator:", str(indicator))
 
-    # download data of band 4, band 5, band 6 and band 7
-    get_bands_data(selected_scenes, ['B4.TIF', 'B5.TIF', 'B6.TIF', 'B7.TIF'])
+def parse_path_rows(value):
+    # '190-27,189-27' -> [(190, 27), (189, 27)]
+    try:
+        return [tuple(int(number) for number in item.split('-', 1)) for item in value.split(',') if item]
+    except ValueError:
+        raise ValueError('Invalid path_rows: {} (expected e.g. 190-27,189-27)'.format(value))
 
-    # masking the bands that were downloaded previously
-    mask_bands(str(location))
 
-    # computing the corresponding indicator
-    compute_indicator('./L8_raw_data/', str(indicator))
+@gzip_page
+def scene_list(request):
+    # Scenes of path/rows (path_rows=190-27,189-27) in a date range (starting_date, ending_date) from the scene
+    # catalogue, one page (page, page_size) at a time, sorted by sort (e.g. acquisitionDate or -cloudCover) and with
+    # only the columns in fields (e.g. productId,acquisitionDate,cloudCover).
+    try:
+        list_of_path_and_rows = parse_path_rows(request.GET.get('path_rows', ''))
+        page_size = min(max(int(request.GET.get('page_size', SCENE_PAGE_SIZE)), 1), MAX_SCENE_PAGE_SIZE)
+        fields = [name for name in request.GET.get('fields', '').split(',') if name] or None
 
-    # creating the final image
-    plotting_image(str(location))
+        catalogue = get_catalogue()
+        indices = catalogue.indices_for_path_rows(list_of_path_and_rows, request.GET.get('starting_date') or None,
+                                                  request.GET.get('ending_date') or None)
+        indices = catalogue.sort_indices(indices, request.GET.get('sort', 'acquisitionDate'))
 
-    # delete all entries in the database tables as they are not needed anymore
-    Location.objects.all().delete()
-    Indicator.objects.all().delete()
+        page = Paginator(indices, page_size).get_page(request.GET.get('page'))
+        results = catalogue.records(page.object_list, fields)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-    # deleting the bands downloaded before and tiff files computed previously as they are not needed anymore
-    for element in glob.glob('./L8_raw_data/*'):
-        if path.isfile(element):
-            os.remove(element)
-        elif path.isdir(element):
-            shutil.rmtree(element)
+    return JsonResponse({
+        'count': page.paginator.count,
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'next': page.next_page_number() if page.has_next() else None,
+        'results': results,
+    })
+
+
+# ------------------------------------------- AWS IMG -------------------------------------------
+def aws_img(request, job_id):
+    # the job processing the selected scenes, its progress is polled by the page (job_status)
+    job = get_object_or_404(Job, id=job_id)
+    print("------------ location:", job.location)
+    print("------------ indicator:", job.indicator)
 
     context = {
-        'scenes': selected_scenes,
+        'job': job,
+        'scenes': job_scenes(job),
     }
 
     return render(request, 'aws_img.html', context)
 
 
+def job_status(request, job_id):
+    # a job which is not finished is only finished by the pool of a running server: the pool is started (recovering the
+    # queued jobs after a restart) and the job is failed if it stopped making progress
+    job = get_object_or_404(Job, id=job_id)
+    if job.state in (Job.QUEUED, Job.RUNNING):
+        get_job_pool()
+        fail_stale_jobs()
+        job.refresh_from_db()
+    done = job.state == Job.DONE
+
+    return JsonResponse({
+        'id': str(job.id),
+        'kind': job.kind,
+        'state': job.state,
+        'stage': job.stage,
+        'percent': job.percent,
+        'error': job.error,
+        'image': reverse('result_image', args=[job.result]) if done and job.kind == Job.IMAGE else None,
+        'statistics': {format: reverse('result_statistics', args=[job.result, format]) for format in ('json', 'csv')}
+        if done and job.kind == Job.STATISTICS else None,
+    })
+
+
+def result_image(request, key):
+    # image of a result from the result cache
+    image_path = get_result_image(key)
+    if image_path is None or not path.isfile(image_path):
+        raise Http404("Result not found")
+
+    return FileResponse(open(image_path, 'rb'), content_type='image/png')
+
+
+STATISTICS_CONTENT_TYPES = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+}
+
+
+def result_statistics(request, key, format):
+    # time series of the statistics of a result (json or csv) from the result cache
+    file_path = get_result_file(key, format) if format in STATISTICS_CONTENT_TYPES else None
+    if file_path is None or not path.isfile(file_path):
+        raise Http404("Result not found")
+
+    return FileResponse(open(file_path, 'rb'), content_type=STATISTICS_CONTENT_TYPES[format],
+                        as_attachment=format == 'csv', filename='statistics.{}'.format(format))
+
+
+def tile_etag(request, job_id, z, x, y):
+    # the results do not change, so the tiles are identified by the key of the result
+    job = Job.objects.filter(id=job_id, state=Job.DONE).first()
+    if job is None:
+        return None
+    return '{}-{}-{}-{}'.format(job.result, z, x, y)
+
+
+@cache_control(public=True, max_age=60 * 60 * 24)
+@condition(etag_func=tile_etag)
+def tile(request, job_id, z, x, y):
+    # web mercator tile of the indicator rasters of a finished job
+    from .tiles import get_tile, valid_tile
+
+    job = get_object_or_404(Job, id=job_id, state=Job.DONE)
+    result_dir = get_result_cache().get_result(job.result)
+    if result_dir is None or not valid_tile(z, x, y):
+        raise Http404("Tile not found")
+
+    return HttpResponse(get_tile(job.result, result_dir, z, x, y), content_type='image/png')
+
+
 # ------------------------------------------- ABOUT -------------------------------------------
 def about(request):
     return render(request, 'about.html', {'title': 'About'})
@@ -201,17 +324,21 @@ def about(request):
 
 # ------------------------------------------- GEE -------------------------------------------
 def google_earth_engine(request):
+    # folium and Earth Engine are only imported when the map is displayed
+    import folium
+    from folium import plugins
+    from .ee_layers import add_ee_layers
+    from .tiles import result_bounds
+
     form_location = FindLocationForm(request.POST or None)
     form_lat_lon = LatLonForm(request.POST or None)
 
-    geolocator = Nominatim(user_agent='satellite_data_processing')
-
     # initial location which is displayed on the map
     ip = get_ip_address(request)  # this code cannot be used when working with the localhost
     ip = '2.56.107.255'  # so the ip address is overwritten with a static ip address for development
     country, city, initial_location_lat, initial_location_lon = get_geoip(ip)
 
-    initial_location = geolocator.geocode(city)
+    initial_location = geocode(', '.join(name for name in [city['city'], city['country_name']] if name))
     initial_location_point = (initial_location_lat, initial_location_lon)
 
     # initial folium map
@@ -223,7 +350,7 @@ def google_earth_engine(request):
 
     if form_location.is_valid():
         location_ = form_location.cleaned_data.get('location')
-        location = geolocator.geocode(location_)
+        location = geocode(location_)
 
         # location coordinates
         location_lat = location.latitude
@@ -271,43 +398,30 @@ def google_earth_engine(request):
     basemaps['Google Maps'].add_to(m)
     basemaps['Google Satellite'].add_to(m)
 
-    # ----------------- JRC Surface Water -----------------
-    dataset = ee.Image('JRC/GSW1_1/GlobalSurfaceWater')
-    occurrence = dataset.select('occurrence')
-    occurrenceVis = {
-        'min': 0.0,
-        'max': 100.0,
-        'palette': ['ffffff', 'ffbbbb', '0000ff']
-        # List of CSS-style color strings (single-band images only)	comma-separated list of hex strings
-    }
-    m.add_ee_layer(occurrence, occurrenceVis, 'JRC Surface Water')
-
-    # ----------------- NDVI (annual) -----------------
-    ndvi_dataset = ee.ImageCollection("LANDSAT/LC08/C01/T1_ANNUAL_NDVI").filterDate('2020-01-01', '2020-12-31')
-    ndvi_colorized = ndvi_dataset.select('NDVI')
-    ndvi_colorizedVis = {
-        'min': 0.0,
-        'max': 1.0,
-        'palette': ['FFFFFF', 'CE7E45', 'DF923D', 'F1B555', 'FCD163', '99B718', '74A901', '66A000', '529400', '3E8601',
-                    '207401', '056201', '004C00', '023B01', '012E01', '011D01', '011301'],
-    }
-    m.add_ee_layer(ndvi_colorized, ndvi_colorizedVis, 'NDVI')
-
-    # ----------------- NDWI (annual) -----------------
-    ndwi_dataset = ee.ImageCollection('LANDSAT/LC08/C01/T1_ANNUAL_NDWI').filterDate('2020-01-01', '2020-12-31')
-    ndwi_colorized = ndwi_dataset.select('NDWI')
-    ndwi_colorizedVis = {
-        'min': 0.0,
-        'max': 1.0,
-        'palette': ['0000ff', '00ffff', 'ffff00', 'ff0000', 'ffffff'],
-    }
-    m.add_ee_layer(ndwi_colorized, ndwi_colorizedVis, 'NDWI')
-
-    # ----------------- Boundaries -----------------
+    # ----------------- Earth Engine layers (JRC Surface Water, NDVI, NDWI, Boundaries) -----------------
+    add_ee_layers(m)
+
+    # ----------------- Result of a job (?job=<id>) -----------------
+    try:
+        job = Job.objects.filter(id=request.GET['job'], kind=Job.IMAGE, state=Job.DONE).first() \
+            if request.GET.get('job') else None
+    except ValidationError:
+        job = None
+    result_dir = get_result_cache().get_result(job.result) if job is not None else None
+    if result_dir is not None:
+        tiles = request.build_absolute_uri(reverse('tile', args=[job.id, 0, 0, 0]))
+        tiles = tiles.replace('/0/0/0.png', '/{z}/{x}/{y}.png')
+        folium.TileLayer(
+            tiles=tiles,
+            attr='Landsat 8 (AWS)',
+            name='{} - {}'.format(job.indicator, job.location),
+            overlay=True,
+            control=True
+        ).add_to(m)
 
-    dataset = ee.FeatureCollection("USDOS/LSIB_SIMPLE/2017")
-    countries = dataset
-    m.add_ee_layer(countries, {}, 'Boundaries')
+        bounds = result_bounds(result_dir)
+        if bounds is not None:
+            m.fit_bounds(bounds)
 
     # Add a layer control panel to the map.
     m.add_child(folium.LayerControl())
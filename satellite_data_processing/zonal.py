@@ -0,0 +1,225 @@
+import concurrent.futures
+import csv
+import json
+
+import numpy as np
+import pandas as pd
+
+# ---------------------------------------------------- Zonal statistics ------------------------------------------------
+# Time series of an indicator over a location (e.g. the NDVI of a country for every date of the selected period)
+# without rendering any image: every scene is downloaded as for the images (band cache), then the indicator is computed
+# from the window of the bands around the location, a block of rows at a time with the same rows of the mask of the
+# location (mask cache), and every block is added to running statistics (count, sum, sum of squares, min, max and a
+# fixed-bin histogram for the percentiles), so no masked band and no full raster of the indicator is kept or written.
+# The scenes are processed in parallel in the process pool of the pipeline, the statistics of the scenes of the same
+# date (e.g. the path/rows of one pass of the satellite) are merged into one row of the time series.
+
+# number of bins of the histogram, the percentiles are interpolated inside a bin
+HISTOGRAM_BINS = 2000
+
+# range of the histogram of the indicators, values outside of the range are counted in the first/last bin (the
+# indicators are never negative and the normalized differences are at most 1)
+HISTOGRAM_RANGE = (0.0, 1.0)
+HISTOGRAM_RANGES = {
+    'SLAVI': (0.0, 10.0),
+}
+
+PERCENTILES = [10, 25, 50, 75, 90]
+
+# columns of the time series (CSV), in this order
+STATISTICS_COLUMNS = ['date', 'scenes', 'pixels', 'valid_pixels', 'valid_fraction', 'mean', 'std', 'min', 'max'] + [
+    'p{}'.format(q) for q in PERCENTILES]
+
+
+class ZonalStatistics:
+    # running statistics of the values of an indicator inside a location, updated block by block and mergeable (the
+    # statistics of several scenes are the statistics of all their pixels)
+
+    def __init__(self, value_range=HISTOGRAM_RANGE, bins=HISTOGRAM_BINS):
+        self.range = tuple(value_range)
+        self.pixels = 0  # pixels inside the location
+        self.count = 0  # pixels inside the location with a value
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.histogram = np.zeros(bins, dtype='int64')
+
+    def update(self, values, pixels):
+        # add the values (1d array without nan) of a block which has pixels pixels inside the location
+        self.pixels += int(pixels)
+        if not values.size:
+            return self
+
+        values = values.astype('float64', copy=False)
+        self.count += values.size
+        self.sum += float(values.sum())
+        self.sum_squares += float(np.dot(values, values))
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        low, high = self.range
+        bins = len(self.histogram)
+        index = (values - low) * (bins / (high - low))
+        np.clip(index, 0, bins - 1, out=index)
+        self.histogram += np.bincount(index.astype('int64'), minlength=bins)
+        return self
+
+    def merge(self, other):
+        self.pixels += other.pixels
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram += other.histogram
+        return self
+
+    def percentile(self, q):
+        # q-th percentile (0-100) from the histogram, interpolated inside its bin and within [min, max]
+        if not self.count:
+            return None
+        cumulative = np.cumsum(self.histogram)
+        rank = q / 100 * self.count
+        k = min(int(np.searchsorted(cumulative, rank)), len(cumulative) - 1)
+        before = cumulative[k - 1] if k else 0
+        fraction = (rank - before) / self.histogram[k] if self.histogram[k] else 0.0
+
+        low, high = self.range
+        width = (high - low) / len(self.histogram)
+        return float(np.clip(low + (k + fraction) * width, self.min, self.max))
+
+    def as_dict(self):
+        if not self.count:
+            mean = std = minimum = maximum = None
+        else:
+            mean = self.sum / self.count
+            std = max(self.sum_squares / self.count - mean * mean, 0.0) ** 0.5
+            minimum, maximum = self.min, self.max
+
+        statistics = {
+            'pixels': self.pixels,
+            'valid_pixels': self.count,
+            'valid_fraction': self.count / self.pixels if self.pixels else None,
+            'mean': mean,
+            'std': std,
+            'min': minimum,
+            'max': maximum,
+        }
+        for q in PERCENTILES:
+            statistics['p{}'.format(q)] = self.percentile(q)
+        return statistics
+
+
+def new_statistics(indicator):
+    return ZonalStatistics(HISTOGRAM_RANGES.get(indicator, HISTOGRAM_RANGE))
+
+
+def band_statistics(band_paths, indicator, location, path_row):
+    # Statistics of an indicator computed from the bands ({band: path}, not masked) of a scene. Only the window of the
+    # bands around the location is read, a block of rows at a time, and the pixels inside the location are given by the
+    # same rows of the mask of the window (from the mask cache, shared with the masking of the bands), so the memory
+    # used depends on the size of a block, not of the scene.
+    import rasterio
+    import rasterio.features
+    from rasterio.errors import WindowError
+    from rasterio.windows import Window
+    from .utils import (BLOCK_ROWS, evaluate_indicator, get_indicator, get_mask_file, get_mask_geometry, read_mask,
+                        required_bands)
+
+    formula = get_indicator(indicator)
+    statistics = new_statistics(indicator)
+
+    sources = {band: rasterio.open(band_paths[band]) for band in required_bands(indicator)}
+    try:
+        first = sources[formula.background]
+        crs = first.crs.to_wkt()
+        geometry = get_mask_geometry(location, crs, abs(first.transform.a))
+        try:
+            window = rasterio.features.geometry_window(first, [geometry])
+        except WindowError:
+            # the scene does not overlap the location
+            return statistics
+        height, width = int(window.height), int(window.width)
+        mask_path = get_mask_file(location, path_row, crs, first.window_transform(window), (height, width), geometry)
+
+        shape = (min(BLOCK_ROWS, height), width)
+        read_buffers = {band: np.empty(shape, dtype='float32') for band in sources}
+        out_buffer = np.empty(shape, dtype='float32')
+        denominator_buffer = np.empty(shape, dtype='float32')
+        scratch_buffer = np.empty(shape, dtype='float32')
+
+        for row_off in range(0, height, BLOCK_ROWS):
+            # block of rows of the window, and the same rows in the bands
+            block = Window(0, row_off, width, min(BLOCK_ROWS, height - row_off))
+            band_window = Window(window.col_off, window.row_off + row_off, block.width, block.height)
+            size = (slice(0, block.height), slice(None))
+            blocks = {band: src.read(1, window=band_window, out=read_buffers[band][size])
+                      for band, src in sources.items()}
+            out = evaluate_indicator(formula, blocks, out_buffer[size], denominator_buffer[size], scratch_buffer[size])
+
+            inside = ~read_mask(mask_path, block)
+            statistics.update(out[inside & ~np.isnan(out)], np.count_nonzero(inside))
+    finally:
+        for src in sources.values():
+            src.close()
+
+    return statistics
+
+
+def scene_statistics(scene, location, indicator):
+    # download one scene (a dataframe with one row) and compute the statistics of the indicator from its bands (no
+    # masked band is written), in a worker process of the pipeline
+    from .utils import band_file_suffixes, find_bands, get_bands_data, required_bands, scene_path_row
+
+    suffixes = band_file_suffixes(indicator)
+    bands = get_bands_data(scene, suffixes, max_workers=len(suffixes))
+
+    statistics = new_statistics(indicator)
+    for product_id, file_paths in bands.items():
+        band_paths = find_bands(file_paths, required_bands(indicator))
+        statistics.merge(band_statistics(band_paths, indicator, location, scene_path_row(product_id)))
+    return statistics
+
+
+def scene_dates(scenes):
+    # date (YYYY-MM-DD) of every scene
+    return pd.to_datetime(scenes['acquisitionDate']).dt.strftime('%Y-%m-%d').tolist()
+
+
+def time_series(scenes, location, indicator, progress=None):
+    # Statistics of the indicator for every date of the scenes, the scenes are processed in parallel.
+    # progress(done, total) is called every time a scene is done. Returns the rows of the time series, sorted by date.
+    from .pipeline import get_process_pool
+
+    pool = get_process_pool()
+    dates = scene_dates(scenes)
+    futures = {pool.submit(scene_statistics, scenes.iloc[[k]], location, indicator): dates[k]
+               for k in range(len(scenes))}
+
+    by_date = {}
+    scene_counts = {}
+    for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+        date = futures[future]
+        statistics = future.result()
+        if date in by_date:
+            by_date[date].merge(statistics)
+        else:
+            by_date[date] = statistics
+        scene_counts[date] = scene_counts.get(date, 0) + 1
+        if progress is not None:
+            progress(n, len(futures))
+
+    return [dict(date=date, scenes=scene_counts[date], **by_date[date].as_dict()) for date in sorted(by_date)]
+
+
+def write_time_series(rows, json_path, csv_path, **metadata):
+    # the time series as JSON ({metadata..., 'statistics': rows}) and as CSV (one row per date)
+    with open(json_path, 'w') as f:
+        json.dump(dict(metadata, statistics=rows), f)
+
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=STATISTICS_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return json_path, csv_path